@@ -1,38 +1,289 @@
 ''' Calling APIs, receiving JSONs and updating JSONs '''
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from urllib.parse import urlparse
+from hashlib import sha256
+from os import makedirs, path
+from tempfile import TemporaryFile
+import sqlite3
 import json
 from datetime import date, datetime, timedelta
+from threading import Lock
+from random import uniform
 import time
 
-from pandas import isnull
+from pandas import DataFrame, isnull
 from pandas.api.types import is_numeric_dtype
 
+class Limiter:
+    ''' token bucket shared by threads calling the same API '''
+    def __init__(self, rate=5, burst=None):
+        self.rate = rate
+        self.burst = burst or rate
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.lock = Lock()
+
+    def wait(self):
+        ''' block until a call is allowed '''
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+            # take a token now and sleep off any deficit
+            self.tokens -= 1
+            delay = -self.tokens / self.rate if self.tokens < 0 else 0
+
+        if delay:
+            time.sleep(delay)
+
+class Cacher:
+    ''' on-disk store of GET responses, evicting the least recently used past a size limit '''
+    def __init__(self, location='./cache/responses.sqlite', max_bytes=200*2**20):
+        makedirs(path.dirname(location), exist_ok=True)
+        self.version_location = path.splitext(location)[0] + '.version'
+        self.max_bytes = max_bytes
+        self.lock = Lock()
+        self.counts = {'hit': 0, 'miss': 0, 'revalidated': 0, 'stored': 0, 'evicted': 0}
+
+        self.connection = sqlite3.connect(location, check_same_thread=False)
+        self.connection.execute('CREATE TABLE IF NOT EXISTS responses ('
+                                'key TEXT PRIMARY KEY, content BLOB, content_type TEXT, '
+                                'etag TEXT, last_modified TEXT, '
+                                'stored REAL, accessed REAL, size INTEGER);')
+        self.connection.commit()
+
+    def get_key(self, method, url, params=None):
+        key = sha256(f'{method.upper()} {url} {json.dumps(params, sort_keys=True, default=str)}'.encode()).hexdigest()
+        return key
+
+    def get(self, key):
+        ''' find a stored response '''
+        with self.lock:
+            entry = self.connection.execute('SELECT content, content_type, etag, last_modified, stored '
+                                            'FROM responses WHERE key = ?;', (key,)).fetchone()
+            if entry:
+                self.connection.execute('UPDATE responses SET accessed = ? WHERE key = ?;', (time.time(), key))
+                self.connection.commit()
+
+        if entry:
+            content, content_type, etag, last_modified, stored = entry
+            entry = {'content': content, 'content_type': content_type,
+                     'etag': etag, 'last_modified': last_modified, 'stored': stored}
+
+        return entry
+
+    def is_fresh(self, entry, ttl):
+        fresh = (entry is not None) and (time.time() - entry['stored'] < ttl)
+        return fresh
+
+    def get_conditions(self, entry):
+        ''' ask the server to only send changes '''
+        headers = {}
+        if entry:
+            if entry['etag']:
+                headers['If-None-Match'] = entry['etag']
+            if entry['last_modified']:
+                headers['If-Modified-Since'] = entry['last_modified']
+
+        return headers
+
+    def put(self, key, response):
+        now = time.time()
+        with self.lock:
+            self.connection.execute('INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?, ?);',
+                                    (key, response.content, response.headers.get('Content-Type', ''),
+                                     response.headers.get('ETag'), response.headers.get('Last-Modified'),
+                                     now, now, len(response.content)))
+            self.connection.commit()
+            self.evict()
+        self.count('stored')
+
+    def refresh(self, key):
+        ''' server says nothing changed, so start the clock again '''
+        with self.lock:
+            self.connection.execute('UPDATE responses SET stored = ? WHERE key = ?;', (time.time(), key))
+            self.connection.commit()
+
+    def evict(self):
+        ''' drop least recently used responses until under the size limit '''
+        total = self.connection.execute('SELECT COALESCE(SUM(size), 0) FROM responses;').fetchone()[0]
+        if total > self.max_bytes:
+            evicted = 0
+            for key, size in self.connection.execute('SELECT key, size FROM responses ORDER BY accessed;').fetchall():
+                if total <= self.max_bytes:
+                    break
+                self.connection.execute('DELETE FROM responses WHERE key = ?;', (key,))
+                total -= size
+                evicted += 1
+
+            self.connection.commit()
+            self.counts['evicted'] += evicted
+
+    def count(self, outcome):
+        with self.lock:
+            self.counts[outcome] += 1
+
+    def get_version(self):
+        ''' fingerprint of the stored responses, ignoring when they were last read '''
+        with self.lock:
+            rows = self.connection.execute('SELECT key, stored, size FROM responses ORDER BY key;').fetchall()
+        version = sha256(json.dumps(rows).encode()).hexdigest()
+
+        return version
+
+    def write_version(self):
+        # CI keys the saved cache on this, so reads alone don't save a new copy
+        with open(self.version_location, 'w') as version_file:
+            version_file.write(self.get_version())
+
+    def print_counts(self):
+        print('Response cache: ' + ', '.join(f'{self.counts[c]} {c}' for c in self.counts))
+
 class Caller:
-    methods = {'get': requests.get,
-               'post': requests.post,
-               'put': requests.put}
+    retry_statuses = [429, 500, 502, 503, 504]
+    retries = 2
+    backoff_base = 1
+    backoff_cap = 60
+    pool_size = 10
+    timeout = 10
+
+    # one pooled session per host and retry setting, shared by every caller
+    sessions = {}
+    sessions_lock = Lock()
+
+    # call count, total seconds and slowest call by host
+    timings = {}
+    timings_lock = Lock()
+
+    # opt in to caching GET responses by setting a Cacher here
+    cacher = None
 
     def __init__(self):
         pass
 
-    def invoke_api(self, url, method='get', **kwargs):
+    def get_session(self, url, retries=None):
+        ''' reuse keep-alive connections to the same host '''
+        retries = self.retries if retries is None else retries
+        key = (urlparse(url).netloc, retries)
+
+        with self.sessions_lock:
+            if key not in self.sessions:
+                # only idempotent methods are retried, honoring Retry-After
+                retry = Retry(total=retries, backoff_factor=self.backoff_base,
+                              status_forcelist=self.retry_statuses,
+                              respect_retry_after_header=True, raise_on_status=False)
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size, max_retries=retry)
+
+                session = requests.Session()
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                self.sessions[key] = session
+
+            session = self.sessions[key]
+
+        return session
+
+    def invoke_api(self, url, method='get', limiter=None, retries=None, ttl=None, cacheable=None, refresh=False,
+                   **kwargs):
+        ''' call an API, using a cached response younger than ttl seconds if caching is on '''
         content = None
         jason = None
 
+        # only GETs with a ttl are cached
+        cacher = self.cacher if (method == 'get') and (ttl is not None) else None
+        if cacher:
+            key = cacher.get_key(method, url, kwargs.get('params'))
+            # a refresh skips whatever is stored, but a good response still replaces it
+            entry = None if refresh else cacher.get(key)
+            if cacher.is_fresh(entry, ttl):
+                cacher.count('hit')
+                return self.parse_content(entry['content'], entry['content_type'])
+
+            kwargs['headers'] = {**kwargs.get('headers', {}), **cacher.get_conditions(entry)}
+
         print_url = self.get_print_url(url)
         
         print(f'Calling {print_url}...')
+        if limiter:
+            limiter.wait()
+
+        start = time.perf_counter()
         try:
-            response = self.methods[method](url=url, timeout=10, **kwargs)
-            if response.ok:
+            response = self.get_session(url, retries).request(method.upper(), url=url, timeout=self.timeout, **kwargs)
+            if cacher and (response.status_code == 304) and entry:
+                cacher.count('revalidated')
+                cacher.refresh(key)
+                content, jason = self.parse_content(entry['content'], entry['content_type'])
+
+            elif response.ok:
                 content, jason = self.extract_json(response)
+                if cacher:
+                    cacher.count('miss')
+                    # some APIs report errors in the body of a good response, which shouldn't be kept
+                    if (cacheable is None) or cacheable(content, jason):
+                        cacher.put(key, response)
 
-        except Exception as e:
+        except requests.RequestException as e:
             print(f'...call failed due to {e}.')
 
+        self.record_timing(url, time.perf_counter() - start)
+
         return content, jason
 
+    def download_api(self, url, method='get', chunk_size=2**20, **kwargs):
+        ''' stream a response body to a temporary file on disk '''
+        r_file = None
+
+        print_url = self.get_print_url(url)
+        
+        print(f'Downloading {print_url}...')
+        start = time.perf_counter()
+        try:
+            with self.get_session(url).request(method.upper(), url=url, timeout=self.timeout, stream=True, **kwargs) as response:
+                if response.ok:
+                    # a real file, since ZipFile needs seekable() which spooled files lack before 3.11
+                    r_file = TemporaryFile()
+                    for chunk in response.iter_content(chunk_size=chunk_size):
+                        r_file.write(chunk)
+                    r_file.seek(0)
+
+        except requests.RequestException as e:
+            print(f'...download failed due to {e}.')
+            if r_file:
+                r_file.close()
+            r_file = None
+
+        self.record_timing(url, time.perf_counter() - start)
+
+        return r_file
+
+    def record_timing(self, url, elapsed):
+        host = urlparse(url).netloc
+        with self.timings_lock:
+            count, total, slowest = self.timings.get(host, [0, 0, 0])
+            self.timings[host] = [count + 1, total + elapsed, max(slowest, elapsed)]
+
+    def print_timings(self):
+        ''' show where time went waiting on APIs '''
+        if len(self.timings):
+            timings_df = DataFrame([[host, *self.timings[host]] for host in self.timings],
+                                   columns=['host', 'calls', 'total', 'slowest'])
+            timings_df['average'] = timings_df['total'] / timings_df['calls']
+            print(f'API timings\n{timings_df.sort_values(by="total", ascending=False).round(3)}')
+
+    def get_backoff(self, attempt, retry_after=None):
+        ''' wait as long as asked, otherwise exponential backoff with full jitter '''
+        if retry_after and str(retry_after).isdigit():
+            delay = min(self.backoff_cap, int(retry_after))
+        else:
+            delay = uniform(0, min(self.backoff_cap, self.backoff_base * 2 ** attempt))
+
+        return delay
+
     def get_print_url(self, url, max_length=60, middle='...', end_length=10):
         print_url = url.replace('https://', '').replace('http://', '')
         if len(print_url) > max_length:
@@ -45,14 +296,21 @@ class Caller:
 
     def extract_json(self, response):
         if response.ok:
-            content = response.content
-            jason = response.json() if len(content) and response.headers.get('Content-Type').startswith('application/json') else None
+            content, jason = self.parse_content(response.content, response.headers.get('Content-Type', ''))
         else:
             content = None
             jason = None
 
         return content, jason
 
+    def parse_content(self, content, content_type):
+        try:
+            jason = json.loads(content) if len(content) and content_type.startswith('application/json') else None
+        except ValueError:
+            jason = None
+
+        return content, jason
+
     def get_token(self, url, refresh_token=None, **kwargs):
         _, token_info = self.invoke_api(url, method='post', **kwargs)
 
@@ -94,6 +352,14 @@ class Recorder:
             json.dump({}, f)
             f.truncate()
 
+    def get_fingerprint(self, league_id):
+        fingerprint = self.database.get_fingerprint(league_id)
+
+        return fingerprint
+
+    def set_fingerprint(self, league_id, sheets, watermark):
+        self.database.store_fingerprint(league_id, sheets, watermark)
+
 class Quoter:
     ''' changes input text to SQL compatible '''
     def __init__(self):
@@ -1,26 +1,52 @@
 ''' Database structure and functions '''
 
+from io import StringIO
+from threading import Lock
+from concurrent.futures import ThreadPoolExecutor
+from random import uniform
+import time
+
 import requests
 from sqlalchemy import create_engine
-from sqlalchemy.exc import OperationalError
+from sqlalchemy.exc import OperationalError, SQLAlchemyError
+from psycopg2 import OperationalError as DriverOperationalError, Error as DriverError
+from psycopg2.extras import execute_values, Json
 from pandas import DataFrame, Series, read_sql
 
 from common.secret import get_secret
 from common.calling import Caller, Quoter
 from common.locations import BITIO_URL, BITIO_HOST
 from common.structure import BITIO_USERNAME, BITIO_DBNAME
-from display.streaming import Streamable, cache
+from display.streaming import Streamable
 
 class Engineer:
-    def __init__(self):
+    ''' one pooled engine per process, shared by every Database '''
+    engines = {}
+    engines_lock = Lock()
+
+    def __init__(self, pool_size=5, max_overflow=10, pool_recycle=1800):
         self.engine_string = (f'postgresql://{BITIO_USERNAME}'
                               f':{get_secret("BITIO_PASSWORD")}@{BITIO_HOST}'
                               f'/{BITIO_USERNAME}/{BITIO_DBNAME}')
-
-    @cache(allow_output_mutation=True, max_entries=10, ttl=10800)
-    def connect(self):  
-        engine = create_engine(self.engine_string)
-        connection = engine.connect()
+        self.pool_size = pool_size
+        self.max_overflow = max_overflow
+        self.pool_recycle = pool_recycle
+
+    def get_engine(self):
+        ''' create the engine once, with connections checked before they are handed out '''
+        key = (self.engine_string, self.pool_size, self.max_overflow, self.pool_recycle)
+        with self.engines_lock:
+            if key not in self.engines:
+                self.engines[key] = create_engine(self.engine_string,
+                                                  pool_pre_ping=True,
+                                                  pool_size=self.pool_size,
+                                                  max_overflow=self.max_overflow,
+                                                  pool_recycle=self.pool_recycle)
+
+        return self.engines[key]
+
+    def connect(self):
+        connection = self.get_engine().connect()
         return connection
 
 class Database(Streamable, Caller):
@@ -34,10 +60,19 @@ class Database(Streamable, Caller):
             'bool': 'bool',
             }
     connection_attempt_limit = 5
-
-    def __init__(self, connection_type='alchemy', streamer=None):
+    # reconnect waits, kept apart from the HTTP retry settings in Caller
+    db_backoff_base = 0.5
+    db_backoff_cap = 30
+    copy_null = '\\N'
+    # characters COPY's text format would otherwise read as escapes
+    copy_escapes = str.maketrans({'\\': '\\\\', '\t': '\\t', '\n': '\\n', '\r': '\\r'})
+
+    def __init__(self, connection_type='alchemy', streamer=None, upsert_engine='values', batch_size=1000,
+                 pool_size=5, max_overflow=10):
         super().__init__()
         self.db = f'{BITIO_USERNAME}/{BITIO_DBNAME}'
+        self.upsert_engine = upsert_engine
+        self.batch_size = batch_size
         
         self.add_streamer(streamer)
         
@@ -46,8 +81,8 @@ class Database(Streamable, Caller):
 
         self.engineer = None
         if self.connection_type == 'alchemy':
-            self.engineer = Engineer()
-            self.connection = self.engineer.connect()
+            self.engineer = Engineer(pool_size=pool_size, max_overflow=max_overflow)
+            self.engine = self.engineer.get_engine()
 
         elif self.connection_type == 'api':
             self.url = BITIO_URL
@@ -62,10 +97,19 @@ class Database(Streamable, Caller):
         self.table_schema = None
         self.view_schema = None
         self.name_schema = None
+        self.name_index = {}
+        self.table_index = {}
         self.schema_loaded = False
         self.load_schema()
 
-        self.materialized = False
+        # only views this instance wrote under are stale, readers never refresh
+        self.dependencies = None
+        self.stale_views = set()
+        self.materialize_lock = Lock()
+
+        # id to name lookups, loaded a table at a time
+        self.names = {}
+        self.names_lock = Lock()
 
     def call_api(self, sql):
         ''' connect to bit.io API '''
@@ -115,7 +159,7 @@ class Database(Streamable, Caller):
                 self.read_sql(sql)
 
     def alchemy_connect(self, method, sql, **kwargs):
-        ''' ping database via SQLAlchemy '''
+        ''' ping database via SQLAlchemy, checking a pooled connection out for each call '''
         limit = self.connection_attempt_limit
         attempt = 0
         success = False
@@ -123,30 +167,84 @@ class Database(Streamable, Caller):
             attempt += 1
             try:
                 if method == 'read':
-                    df = read_sql(sql, self.connection, **kwargs)
+                    with self.engine.connect() as connection:
+                        df = read_sql(sql, connection, **kwargs)
                 elif method == 'execute':
-                    df = self.connection.execute(sql)
+                    with self.engine.begin() as connection:
+                        df = connection.execute(sql).rowcount
+                elif method == 'copy':
+                    df = self.copy_execute(*sql, **kwargs)
+                elif method == 'params':
+                    df = self.params_execute(sql, **kwargs)
                 success = True
 
-            except OperationalError:
-                self.connection = self.engineer.connect()
-                self.streamer.print(f'Database connection failed, retrying [attempt {attempt}/{limit}]')
+            except (OperationalError, DriverOperationalError):
+                if attempt == limit:
+                    raise
+
+                wait = self.get_db_backoff(attempt)
+                self.streamer.print(f'Database connection failed, retrying in {wait:.1f}s [attempt {attempt}/{limit}]')
+                time.sleep(wait)
 
         return df
 
+    def get_db_backoff(self, attempt):
+        ''' exponential backoff with full jitter '''
+        wait = uniform(0, min(self.db_backoff_cap, self.db_backoff_base * 2**(attempt - 1)))
+
+        return wait
+
+    def copy_execute(self, sql_before, sql_copy, sql_after, buffer=None):
+        ''' stream a buffer through COPY between two statements in one transaction '''
+        raw_connection = self.engine.raw_connection()
+        buffer.seek(0)
+        try:
+            with raw_connection.cursor() as cursor:
+                cursor.execute(sql_before)
+                cursor.copy_expert(sql_copy, buffer)
+                cursor.execute(sql_after)
+                rowcount = cursor.fetchall() if cursor.description else cursor.rowcount
+            raw_connection.commit()
+
+        except Exception:
+            raw_connection.rollback()
+            raise
+
+        finally:
+            # hand the connection back to the pool
+            raw_connection.close()
+
+        return rowcount
+
+    def params_execute(self, sql, rows=None, template=None, fetch=False):
+        ''' run one statement over batches of bound rows in one transaction '''
+        raw_connection = self.engine.raw_connection()
+        try:
+            with raw_connection.cursor() as cursor:
+                returned = execute_values(cursor, sql, rows, template=template, page_size=self.batch_size, fetch=fetch)
+                rowcount = returned if fetch else cursor.rowcount
+            raw_connection.commit()
+
+        except Exception:
+            raw_connection.rollback()
+            raise
+
+        finally:
+            # hand the connection back to the pool
+            raw_connection.close()
+
+        return rowcount
+
     def table_name(self, table_name:str) -> str:
         ''' get table, view or materialized view name '''
         material = '_m'
         if self.schema_loaded:
-            relationship = self.name_schema.query('table_name.str.lower() == @table_name.lower()')['relationship'].iloc[0].lower()
+            relationship = self.name_index.get(table_name.lower())
 
-            if relationship == 'view' and len(self.name_schema.query('table_name.str.lower() == @table_name.lower() + "_m"')['relationship']):
-                name = table_name + '_m'
+            if relationship == 'view' and ((table_name.lower() + material) in self.name_index):
+                name = table_name + material
             else:
                 name = table_name
-
-            if name[:-len(material)] == material:
-                self.materialize()
         else:
             name = table_name
 
@@ -161,43 +259,176 @@ class Database(Streamable, Caller):
         self.name_schema = self.get_table('_schema_names')
         self.schema_loaded = all(s is not None for s in [self.table_schema, self.view_schema, self.name_schema])
 
+        if self.schema_loaded:
+            self.index_schema()
+
+    def index_schema(self):
+        ''' build lookups so name, key and column checks don't need to query the schema '''
+        self.name_index = {str(n).lower(): str(r).lower() \
+            for n, r in self.name_schema[['table_name', 'relationship']].values}
+
+        self.table_index = {}
+        for table_name, column_name, column_type in self.table_schema[['table_name', 'column_name', 'column_type']].values:
+            index = self.table_index.setdefault(table_name, {'keys': [], 'values': [], 'columns': []})
+            if column_type == 'PRIMARY KEY':
+                index['keys'].append(column_name)
+            if column_name not in index['columns']:
+                # the first entry for a column decides if it is a value
+                index['columns'].append(column_name)
+                if column_type != 'PRIMARY KEY':
+                    index['values'].append(column_name)
+
     def materialize(self, table_name=None):
-        ''' refresh a materialzied view '''
-        if table_name:
-            sql = (f'REFRESH MATERIALIZED VIEW {self.table_name(table_name)};')
-            self.execute_sql(sql)
+        ''' refresh materialized views made stale by this writer, upstream views first '''
+        # writers on other threads wait rather than refreshing the same view twice
+        with self.materialize_lock:
+            if len(self.stale_views):
+                dependencies = self.get_dependencies()
+
+                if table_name:
+                    m_views = self.get_upstream(table_name.lower()) + [table_name.lower()]
+                else:
+                    m_views = self.sort_views(sorted(self.stale_views))
+
+                for m_view in m_views:
+                    if m_view in self.stale_views:
+                        concurrently = 'CONCURRENTLY ' if dependencies.get(m_view, {}).get('unique') else ''
+                        sql = (f'REFRESH MATERIALIZED VIEW {concurrently}"{self.db}".{m_view};')
+                        self.execute_sql(sql)
+                        self.stale_views.discard(m_view)
+
+    def get_dependencies(self):
+        ''' find the base tables and upstream materialized views of each materialized view '''
+        if self.dependencies is None:
+            sql_edges = (f'SELECT DISTINCT v.relname AS view_name, t.relname AS table_name, t.relkind AS kind '
+                         f'FROM pg_depend AS d '
+                         f'JOIN pg_rewrite AS r ON d.objid = r.oid '
+                         f'JOIN pg_class AS v ON r.ev_class = v.oid '
+                         f'JOIN pg_class AS t ON d.refobjid = t.oid '
+                         f'JOIN pg_namespace AS n ON v.relnamespace = n.oid '
+                         f"WHERE d.classid = 'pg_rewrite'::regclass AND d.refclassid = 'pg_class'::regclass "
+                         f"AND v.oid <> t.oid AND n.nspname = '{self.db}';"
+                         )
+
+            sql_uniques = (f'SELECT m.matviewname AS view_name, '
+                           f'EXISTS (SELECT 1 FROM pg_index AS i JOIN pg_class AS c ON i.indrelid = c.oid '
+                           f'JOIN pg_namespace AS n ON c.relnamespace = n.oid '
+                           f'WHERE c.relname = m.matviewname AND n.nspname = m.schemaname '
+                           f'AND i.indisunique AND i.indpred IS NULL) AS is_unique '
+                           f'FROM pg_matviews AS m '
+                           f"WHERE m.schemaname = '{self.db}' AND m.ispopulated;"
+                           )
 
-        else:
-            if not self.materialized:
-                material_views = self.name_schema.query('relationship.str.lower() == "materialized"')['name'].to_list()
-                for m_view in material_views:
-                    ## add a way to check dependencies
-                    sql = (f'REFRESH MATERIALIZED VIEW {self.table_name(m_view)};')
-                    self.execute_sql(sql)
+            try:
+                edges_df = self.read_sql(sql_edges)
+                uniques_df = self.read_sql(sql_uniques)
+            except (SQLAlchemyError, DriverError) as error:
+                # this runs from mark_written after a write has committed, so fall back rather than raise
+                self.streamer.print(f'Could not read view dependencies, refreshing all materialized views on writes: {error}')
+                edges_df = None
+                uniques_df = None
+
+            if (edges_df is None) or (uniques_df is None):
+                # no catalog access, so any write could touch any materialized view
+                m_views = sorted(n for n, r in self.name_index.items() if r == 'materialized')
+                self.dependencies = {m: {'tables': None, 'views': [], 'unique': False} for m in m_views}
 
-                self.materialized = True
+            else:
+                self.dependencies = self.build_dependencies(edges_df, dict(uniques_df.values))
+
+        return self.dependencies
+
+    def build_dependencies(self, edges_df, uniques):
+        ''' walk through plain views to reach base tables and materialized views '''
+        edges = {}
+        kinds = {}
+        for view_name, table_name, kind in edges_df[['view_name', 'table_name', 'kind']].values:
+            edges.setdefault(view_name, set()).add(table_name)
+            kinds[table_name] = kind
+
+        def walk(name, seen):
+            tables = set()
+            views = set()
+            for table_name in edges.get(name, set()) - seen:
+                seen.add(table_name)
+                if kinds[table_name] == 'r':
+                    tables.add(table_name)
+                elif kinds[table_name] == 'm':
+                    views.add(table_name)
+                else:
+                    sub_tables, sub_views = walk(table_name, seen)
+                    tables |= sub_tables
+                    views |= sub_views
+
+            return tables, views
+
+        dependencies = {}
+        m_views = set(uniques) | {t for t in kinds if kinds[t] == 'm'}
+        for m_view in m_views:
+            tables, views = walk(m_view, {m_view})
+            dependencies[m_view] = {'tables': tables, 'views': sorted(views), 'unique': bool(uniques.get(m_view))}
+
+        return dependencies
+
+    def get_upstream(self, m_view):
+        ''' materialized views that need to be refreshed before this one, in order '''
+        upstream = []
+        for view in self.dependencies.get(m_view, {}).get('views', []):
+            for v in self.get_upstream(view) + [view]:
+                if v not in upstream:
+                    upstream.append(v)
+
+        return upstream
+
+    def sort_views(self, m_views):
+        ''' order materialized views so upstream views come first '''
+        sorted_views = []
+        for m_view in m_views:
+            for v in self.get_upstream(m_view) + [m_view]:
+                if v not in sorted_views:
+                    sorted_views.append(v)
+
+        return sorted_views
+
+    def mark_written(self, table_name):
+        ''' any materialized view built on a written table needs a refresh '''
+        if self.schema_loaded:
+            # workers store leagues on several threads
+            with self.materialize_lock:
+                dependencies = self.get_dependencies()
+                written = table_name.lower()
+                stale = {m for m in dependencies if (dependencies[m]['tables'] is None) or (written in dependencies[m]['tables'])}
+
+                # and so does anything downstream of those
+                stale_n = 0
+                while len(stale) != stale_n:
+                    stale_n = len(stale)
+                    stale |= {m for m in dependencies if stale & set(dependencies[m]['views'])}
+
+                self.stale_views |= stale
+
+        # names may have changed
+        self.names.pop(table_name.lower().rstrip('s'), None)
 
     def get_keys(self, table_name):
         ''' get table key columns '''
-        q = '(column_type == "PRIMARY KEY") & (table_name == @table_name.lower())'
-        keys = self.table_schema.query(q)['column_name'].to_list()
+        keys = list(self.table_index.get(table_name.lower(), {}).get('keys', []))
 
         return keys
 
     def get_values(self, table_name, match_cols=None):
         ''' get table value columns '''
-        q = '(column_type != "PRIMARY KEY") & (table_name == @table_name.lower())'
+        values = self.table_index.get(table_name.lower(), {}).get('values', [])
         if len(match_cols):
-            q += ' & (column_name in @match_cols)'
-        values = self.table_schema.drop_duplicates(['table_name', 'column_name'])\
-            .query(q)['column_name'].to_list()
+            match_cols = set(match_cols)
+            values = [v for v in values if v in match_cols]
+        else:
+            values = list(values)
 
         return values
 
     def get_columns(self, table_name):
-        q = 'table_name == @table_name.lower()'
-        columns = self.table_schema.drop_duplicates(['table_name', 'column_name'])\
-            .query(q)['column_name'].to_list()
+        columns = list(self.table_index.get(table_name.lower(), {}).get('columns', []))
         return columns
 
     def get_table(self, table_name, league_id=None, columns=None, order_by=None, drop_league=False, **kwargs):
@@ -235,8 +466,9 @@ class Database(Streamable, Caller):
             values = ', '.join('(' + ', '.join(self.needs_quotes(df.loc[i, col]) for col in all_columns) + ')' for i in df.index)
             cols = ', '.join(f'{col}' for col in all_columns)
             wheres = ' AND '.join(f'(c.{key} = t.{key})' for key in keys)
+            changes = self.is_distinct(value_columns, 't', 'c')
                 
-            sql = f'UPDATE {self.table_name(table_name)} AS t SET {sets} FROM (VALUES {values}) AS c({cols}) WHERE {wheres};'
+            sql = f'UPDATE {self.table_name(table_name)} AS t SET {sets} FROM (VALUES {values}) AS c({cols}) WHERE {wheres} AND ({changes});'
 
         return sql
 
@@ -259,8 +491,113 @@ class Database(Streamable, Caller):
        
         return df_updates, df_inserts
 
-    def upsert_table(self, table_name, df):
+    def to_copy_text(self, item):
+        ''' write a cell the way COPY's text format reads it '''
+        value = self.to_value(item)
+        if value is None:
+            text = self.copy_null
+        else:
+            text = (self.quoter.dump_json(value) if self.quoter.jsonable(value) else str(value)).translate(self.copy_escapes)
+
+        return text
+
+    def to_copy_buffer(self, df):
+        ''' write dataframe as tab separated text that COPY can read, with \\N as NULL '''
+        buffer = StringIO()
+        for row in df.itertuples(index=False, name=None):
+            buffer.write('\t'.join(self.to_copy_text(item) for item in row) + '\n')
+
+        return buffer
+
+    def is_distinct(self, columns, existing, incoming):
+        ''' write SQL that is true when any value differs, comparing as text so JSON columns work too '''
+        changes = ' OR '.join(f'({existing}.{col}::text IS DISTINCT FROM {incoming}.{col}::text)' for col in columns)
+
+        return changes
+
+    def on_conflict(self, columns, keys):
+        ''' write SQL to update value columns when keys already exist and something changed '''
+        value_columns = [col for col in columns if col not in keys]
+        sets = ', '.join(f'{col} = EXCLUDED.{col}' for col in value_columns)
+        conflict = (f'DO UPDATE SET {sets} WHERE {self.is_distinct(value_columns, "t", "EXCLUDED")}' \
+                    if len(value_columns) else 'DO NOTHING')
+
+        # untouched rows return nothing, and xmax is only 0 for new rows
+        return f'ON CONFLICT ({", ".join(keys)}) {conflict} RETURNING (xmax = 0) AS inserted'
+
+    def count_writes(self, table_name, returned, total):
+        ''' report how many rows were actually written '''
+        inserted = sum(1 for row in returned if row[0])
+        updated = len(returned) - inserted
+        counts = {'inserted': inserted, 'updated': updated, 'unchanged': total - inserted - updated}
+        self.streamer.print(f'\t...{table_name}: ' + ', '.join(f'{counts[c]} {c}' for c in counts))
+
+        return counts
+
+    def copy_rows(self, table_name, df, keys):
+        ''' upsert through a temp table loaded with COPY and a single INSERT ... ON CONFLICT '''
+        columns = df.columns.to_list()
+        temp_name = f'_upsert_{table_name.lower()}'
+        cols = ', '.join(columns)
+
+        sql_before = (f'CREATE TEMP TABLE {temp_name} '
+                      f'(LIKE {self.table_name(table_name)} INCLUDING DEFAULTS) ON COMMIT DROP;')
+        sql_copy = f'COPY {temp_name} ({cols}) FROM STDIN WITH (FORMAT text);'
+        sql_after = (f'INSERT INTO {self.table_name(table_name)} AS t ({cols}) '
+                     f'SELECT {cols} FROM {temp_name} '
+                     f'{self.on_conflict(columns, keys)};')
+
+        buffer = self.to_copy_buffer(df)
+        returned = self.alchemy_connect('copy', (sql_before, sql_copy, sql_after), buffer=buffer)
+
+        return self.count_writes(table_name, returned, len(df))
+
+    def to_value(self, item):
+        ''' change a cell into a plain value, with the same NA rule for every engine '''
+        if self.quoter.jsonable(item):
+            value = list(item) if isinstance(item, set) else item
+        elif self.quoter.nullable(item):
+            value = None
+        else:
+            # numpy scalars
+            value = item.item() if hasattr(item, 'item') else item
+            if isinstance(value, float) and value.is_integer():
+                # integers that picked up NA come through as floats
+                value = int(value)
+
+        return value
+
+    def to_param(self, item):
+        ''' change a cell into something the driver can bind '''
+        value = self.to_value(item)
+        param = Json(value) if self.quoter.jsonable(value) else value
+
+        return param
+
+    def to_params(self, df):
+        ''' turn dataframe rows into tuples of bound parameters '''
+        params = [tuple(self.to_param(item) for item in row) for row in df.itertuples(index=False, name=None)]
+
+        return params
+
+    def params_rows(self, table_name, df, keys):
+        ''' upsert with bound parameters in batches instead of literal SQL '''
+        columns = df.columns.to_list()
+
+        sql = (f'INSERT INTO {self.table_name(table_name)} AS t ({", ".join(columns)}) VALUES %s '
+               f'{self.on_conflict(columns, keys)};')
+
+        returned = self.alchemy_connect('params', sql, rows=self.to_params(df), fetch=True)
+
+        return self.count_writes(table_name, returned, len(df))
+
+    def upsert_table(self, table_name, df, engine=None):
         # update existing rows and insert new rows
+        engine = engine if engine else self.upsert_engine
+        if self.connection_type != 'alchemy':
+            # COPY and bound parameters need a direct connection
+            engine = 'values'
+
         if len(df):
             # there are values to store
             # remove potential index issues
@@ -271,26 +608,46 @@ class Database(Streamable, Caller):
             # retain key columns that have NA values, such as Votes table
             value_columns = self.get_values(table_name, match_cols=df_upsert.columns)
             df_store = df_upsert.drop(columns=df_upsert[value_columns].columns[df_upsert[value_columns].isna().all()])
-            
-            # get current league if not upserting Leagues or table that doesn't have league as a key
-            if ('league_id' in self.get_keys(table_name)) and (len(df_store['league_id'].unique()) == 1): 
-                league_id = df_store['league_id'].iloc[0]
+
+            if not set(self.get_columns(table_name)) <= set(df_store.columns):
+                # INSERT ... ON CONFLICT checks NOT NULL on the whole new row before it finds the conflict,
+                # so writes that only fill in some columns update existing rows in place
+                engine = 'values'
+
+            # let the database sort out existing, changed and new rows
+            if engine == 'copy':
+                counts = self.copy_rows(table_name, df_store.drop_duplicates(subset=keys, keep='last'), keys)
+            elif engine == 'params':
+                counts = self.params_rows(table_name, df_store.drop_duplicates(subset=keys, keep='last'), keys)
             else:
-                league_id = None
-            
-            # get existing ids in database
-            df_existing = self.get_table(table_name, columns=keys, league_id=league_id)
+                self.values_rows(table_name, df_store, keys)
+                counts = None
+
+            # views only go stale if something was written
+            if (counts is None) or counts['inserted'] or counts['updated']:
+                self.mark_written(table_name)
+
+    def values_rows(self, table_name, df_store, keys):
+        ''' upsert with literal UPDATE ... FROM (VALUES ...) and INSERT ... VALUES statements '''
+        # get current league if not upserting Leagues or table that doesn't have league as a key
+        if ('league_id' in keys) and (len(df_store['league_id'].unique()) == 1): 
+            league_id = df_store['league_id'].iloc[0]
+        else:
+            league_id = None
+        
+        # get existing ids in database
+        df_existing = self.get_table(table_name, columns=keys, league_id=league_id)
 
-            # split dataframe into existing updates and new inserts
-            df_updates, df_inserts = self.find_existing(df_store, df_existing, keys)
+        # split dataframe into existing updates and new inserts
+        df_updates, df_inserts = self.find_existing(df_store, df_existing, keys)
 
-            # write SQL for updates and inserts
-            sql_updates = self.update_rows(table_name, df_updates, keys)
-            sql_inserts = self.insert_rows(table_name, df_inserts)         
+        # write SQL for updates and inserts
+        sql_updates = self.update_rows(table_name, df_updates, keys)
+        sql_inserts = self.insert_rows(table_name, df_inserts)         
 
-            # execute SQL
-            self.execute_sql(sql_updates)
-            self.execute_sql(sql_inserts)
+        # execute SQL
+        self.execute_sql(sql_updates)
+        self.execute_sql(sql_inserts)
 
     # query functions
     def get_player_match(self, league_id, partial_name):
@@ -345,6 +702,29 @@ class Database(Streamable, Caller):
         df = leagues_df.reindex(columns=self.get_columns('leagues')) ## is this reindexing still necessary?
         self.upsert_table('leagues', df)
 
+    def get_fingerprint(self, league_id):
+        ''' what a league export looked like when it was last stored '''
+        # leagues without a fingerprint column are always stored in full
+        if 'fingerprint' in self.get_columns('leagues'):
+            leagues_df = self.get_table('leagues', league_id=league_id, columns=['fingerprint'])
+            fingerprint = leagues_df['fingerprint'].iloc[0] if len(leagues_df) else None
+            if isinstance(fingerprint, str):
+                fingerprint = self.quoter.load_json(fingerprint)
+        else:
+            fingerprint = None
+
+        return fingerprint if isinstance(fingerprint, dict) else None
+
+    def store_fingerprint(self, league_id, sheets, watermark):
+        if 'fingerprint' in self.get_columns('leagues'):
+            sql = (f'UPDATE {self.table_name("leagues")} '
+                   f'SET fingerprint = {self.needs_quotes({"sheets": sheets, "watermark": watermark})} '
+                   f'WHERE league_id = {self.needs_quotes(league_id)};'
+                   )
+
+            # no view reads the fingerprint, so nothing goes stale
+            self.execute_sql(sql)
+
     def get_league_creator(self, league_id):
         # get name of league creator
         leagues_df = self.get_table('leagues', league_id=league_id)
@@ -482,6 +862,7 @@ class Database(Streamable, Caller):
                    f'AND league_id = {self.needs_quotes(league_id)}; '
                    )
             self.execute_sql(sql)
+            self.mark_written('members')
 
         elif isinstance(active_players, str):
             wheres = f'AND league_id = {league_id}' if league_id else ''
@@ -514,12 +895,39 @@ class Database(Streamable, Caller):
         
         return player_names
 
+    def get_name_index(self, table):
+        ''' load every id and name for a table in one query '''
+        with self.names_lock:
+            if table not in self.names:
+                sql = f'SELECT {table}_id, {table}_name FROM {self.table_name(table + "s")}'
+                names_df = self.read_sql(sql)
+                self.names[table] = dict(zip(names_df[f'{table}_id'], names_df[f'{table}_name']))
+
+            index = self.names[table]
+
+        return index
+
     def get_name(self, id, table):
-        sql = f'SELECT {table}_name FROM {self.table_name(table + "s")} WHERE {table}_id = {self.needs_quotes(id)}'
-        name = self.read_sql(sql)[f'{table}_name'].squeeze()
+        index = self.get_name_index(table)
+        if id in index:
+            name = index[id]
+
+        else:
+            # not loaded yet, so look it up directly
+            sql = f'SELECT {table}_name FROM {self.table_name(table + "s")} WHERE {table}_id = {self.needs_quotes(id)}'
+            name = self.read_sql(sql)[f'{table}_name'].squeeze()
+            if isinstance(name, str):
+                index[id] = name
 
         return name
 
+    def get_names(self, ids, table):
+        ''' look up many names at once '''
+        index = self.get_name_index(table)
+        names = [index[id] if id in index else self.get_name(id, table) for id in ids]
+
+        return names
+
     def get_player_name(self, player_id):  
         return self.get_name(player_id, 'player')
 
@@ -621,6 +1029,10 @@ class Database(Streamable, Caller):
                )
 
         self.execute_sql(sql)
+        self.mark_written('players')
+
+        # the next update run reads flagged players from the refreshed view
+        self.materialize()
 
     def get_players_update_sp(self):
         players_df = self.get_table('updates_spotify_players')
@@ -741,6 +1153,40 @@ class Database(Streamable, Caller):
 
         return results_df
 
+    def get_league_bundle(self, league_id, player_id=None, names=None, workers=8):
+        ''' fetch everything a league page plots at once over pooled connections '''
+        calls = {'boards_df': (self.get_boards, [league_id], {}),
+                 'creators_winners_df': (self.get_creators_and_winners, [league_id], {}),
+                 'competitions_df': (self.get_competitions, [league_id], {}),
+                 'rankings_df': (self.get_rankings, [league_id], {}),
+                 'awards_round_df': (self.get_round_awards, [league_id], {}),
+                 'awards_league_df': (self.get_league_awards, [league_id], {}),
+                 'features_df': (self.get_audio_features, [league_id], {}),
+                 'mappings_df': (self.get_mappings, [league_id], {}),
+                 'genres_df': (self.get_occurances, [league_id], {'genres': True, 'tags': True}),
+                 'categories_df': (self.get_occurances, [league_id], {'categories': True}),
+                 'tags_df': (self.get_occurances, [league_id], {'player_id': player_id, 'genres': True, 'tags': True}),
+                 'exclusives_df': (self.get_exclusive_genres, [league_id], {}),
+                 'results_df': (self.get_song_results, [league_id], {}),
+                 'descriptions_df': (self.get_round_descriptions, [league_id], {}),
+                 'playlists_df': (self.get_playlists, [league_id], {}),
+                 'duration': (self.get_track_count_and_duration, [league_id], {}),
+                 }
+        if names is not None:
+            calls = {name: calls[name] for name in names if name in calls}
+
+        if self.connection_type != 'alchemy':
+            # API calls don't share a pool
+            workers = 1
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {name: executor.submit(func, *args, **kwargs) for name, (func, args, kwargs) in calls.items()}
+
+        # leave out anything that failed so the caller can retry it on its own
+        bundle = {name: futures[name].result() for name in futures if futures[name].exception() is None}
+
+        return bundle
+
     def get_round_descriptions(self, league_id):
         descriptions_df = self.get_table('rounds', league_id=league_id)[['round_id', 'description']]
 
@@ -933,6 +1379,7 @@ class Database(Streamable, Caller):
                )
 
         self.execute_sql(sql)
+        self.mark_written('competitions')
 
     def get_emojis(self):
         emojis_df = self.get_table('emojis')
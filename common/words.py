@@ -1,9 +1,11 @@
 ''' Language processing '''
 
 import re
+from functools import lru_cache
 
-from thefuzz import process
+from thefuzz import process, fuzz, utils
 from numpy import ndarray
+from pandas import Series
 
 class Texter:
     emoji_pattern = re.compile('['
@@ -58,38 +60,46 @@ class Texter:
 
         return display_name.strip()
 
-    def slashable(self, char):
+    @staticmethod
+    def slashable(char):
         slash_chars = ['[', '(', ']', ')', '.', '\\', '-']
         slash = '\\' if char in slash_chars else ''
         return slash
 
+    @staticmethod
+    @lru_cache(maxsize=256)
+    def compile_parenthetical(words, position, parentheses, middle, case_sensitive):
+        ''' build the alternation for each combination of arguments only once '''
+        punctuation = '!,.;()/\\-[]'
+        punctuation_s = '^' + punctuation
+        punctuation_e = punctuation + '$'
+
+        if parentheses == 'all':
+            parentheses = [[start, end] for start in punctuation_s for end in punctuation_e]
+        elif parentheses == 'all_start':
+            [[start, ''] for start in punctuation_s]
+        elif parentheses == 'all_end':
+            parentheses = [['', end] for end in punctuation_e]
+
+        capture_s = '(.*?)' if position == 'end' else ''
+        capture_e = '(.*?)' if position == 'start' else ''
+        capture_m = f'.*?{middle}.*?' if middle else ''
+
+        pattern = '|'.join(f'({Texter.slashable(s)}{s}{capture_s}'
+                           f'{w}{capture_m}'
+                           f'{capture_e}{Texter.slashable(e)}{e})' for w in words for s, e in parentheses)
+    
+        flags = re.IGNORECASE if not case_sensitive else 0
+
+        return re.compile(pattern, flags=flags)
+
     def remove_parenthetical(self, text, words, position, parentheses=[['(', ')'], ['[', ']']],
                              middle=None, case_sensitive=False):
         captured = None
         if text:
+            pattern = self.get_parenthetical(words, position, parentheses, middle, case_sensitive)
 
-            punctuation = '!,.;()/\\-[]'
-            punctuation_s = '^' + punctuation
-            punctuation_e = punctuation + '$'
-
-            if parentheses == 'all':
-                parentheses = [[start, end] for start in punctuation_s for end in punctuation_e]
-            elif parentheses == 'all_start':
-                [[start, ''] for start in punctuation_s]
-            elif parentheses == 'all_end':
-                parentheses = [['', end] for end in punctuation_e]
-
-            capture_s = '(.*?)' if position == 'end' else ''
-            capture_e = '(.*?)' if position == 'start' else ''
-            capture_m = f'.*?{middle}.*?' if middle else ''
-
-            pattern = '|'.join(f'({self.slashable(s)}{s}{capture_s}'
-                               f'{w}{capture_m}'
-                               f'{capture_e}{self.slashable(e)}{e})' for w in words for s, e in parentheses)
-        
-            flags = re.IGNORECASE if not case_sensitive else 0
-
-            searched = re.search(pattern, text, flags=flags)
+            searched = pattern.search(text)
             if searched:
                 # find the shortest captured text
                 captured = sorted((s for s in searched.groups()[1::2] if (s is not None)), key=len)[0].strip()
@@ -99,6 +109,31 @@ class Texter:
             
         return text, captured
 
+    def get_parenthetical(self, words, position, parentheses, middle=None, case_sensitive=False):
+        # arguments need to be hashable to look up the compiled pattern, and middle is used as written
+        pattern = self.compile_parenthetical(tuple(words), position,
+                                             parentheses if isinstance(parentheses, str) else tuple(map(tuple, parentheses)),
+                                             str(middle) if middle else None, case_sensitive)
+
+        return pattern
+
+    def remove_parentheticals(self, texts, words, position, parentheses=[['(', ')'], ['[', ']']],
+                              middle=None, case_sensitive=False):
+        ''' remove_parenthetical for a whole Series at once '''
+        pattern = self.get_parenthetical(words, position, parentheses, middle, case_sensitive)
+        groups = texts.str.extract(pattern.pattern, flags=pattern.flags, expand=True)
+
+        # only one alternative can match, so its groups are the only ones filled
+        # and a column with no matches at all comes back as floats, which .str won't take
+        strip = lambda x: x.strip() if isinstance(x, str) else None
+        replaceable = groups.iloc[:, 0::2].bfill(axis=1).iloc[:, 0].map(strip).astype(object)
+        captured = groups.iloc[:, 1::2].bfill(axis=1).iloc[:, 0].map(strip).astype(object)
+
+        texts = Series([t.replace(r, '').strip() if isinstance(r, str) else t for t, r in zip(texts, replaceable)],
+                       index=texts.index, dtype=object)
+
+        return texts, captured
+
     def drop_dash(self, text):
         # remove description after dash
         if ' - ' in text:
@@ -171,7 +206,7 @@ class Texter:
         # return any words after the first word as initials
         punctuation = '- .'
         pattern = '|'.join(f'{self.slashable(p)}{p}' for p in punctuation)
-        abbreviation = ''.join(s if i == 0 else s[0] for i, s in enumerate(re.split(pattern, text.strip())))
+        abbreviation = ''.join(s if i == 0 else s[:1] for i, s in enumerate(re.split(pattern, text.strip())))
 
         return abbreviation
 
@@ -250,4 +285,106 @@ class Texter:
 
         ordinal = f'{num}{nth}'
 
-        return ordinal
\ No newline at end of file
+        return ordinal
+
+class NameMatcher:
+    ''' fuzzy matches text against one fixed list of names '''
+    # length of the pieces used to shortlist names
+    ngram_size = 3
+    # most scored matches kept, same as before
+    limit = 10
+    # text this short can partly match almost any name, so it is scored against all of them
+    short_length = 4
+
+    def __init__(self, names, threshold=40, similarity=5):
+        self.texter = Texter()
+        self.threshold = threshold
+        self.similarity = similarity
+
+        # keep the first of each name and skip blanks
+        self.names = [n for n in dict.fromkeys(names) if isinstance(n, str) and len(n.strip())]
+        self.name_set = set(self.names)
+
+        # normalize once the way the scorer would on every call
+        self.normalized = [self.normalize(n) for n in self.names]
+        self.abbreviations = [self.normalize(self.texter.abbreviate_name(n)) for n in self.names]
+
+        # map each n-gram and abbreviation to the names that have it
+        self.index = {}
+        for i, (normal, abbreviation) in enumerate(zip(self.normalized, self.abbreviations)):
+            for key in self.get_ngrams(normal) | {abbreviation}:
+                self.index.setdefault(key, set()).add(i)
+
+        # longest names first so a full name beats a shorter name inside it
+        self.pattern = re.compile('|'.join(re.escape(n) for n in sorted(self.names, key=len, reverse=True))) \
+            if len(self.names) else None
+
+    def normalize(self, text):
+        return utils.full_process(text, force_ascii=True)
+
+    def get_ngrams(self, text):
+        padded = f' {text} '
+        if len(padded) <= self.ngram_size:
+            ngrams = {padded}
+        else:
+            ngrams = {padded[i:i+self.ngram_size] for i in range(len(padded) - self.ngram_size + 1)}
+
+        return ngrams
+
+    def get_shortlist(self, text):
+        if len(text) <= self.short_length:
+            shortlist = range(len(self.names))
+
+        else:
+            # only names that share a piece with the text are worth scoring
+            shortlist = set()
+            for key in self.get_ngrams(text) | {self.normalize(self.texter.abbreviate_name(text))}:
+                shortlist |= self.index.get(key, set())
+            shortlist = sorted(shortlist)
+
+        return shortlist
+
+    def score(self, text, candidates):
+        # best first, keeping name order for ties
+        scores = sorted(((i, fuzz.WRatio(text, self.normalized[i], full_process=False)) for i in candidates),
+                        key=lambda x: -x[1])
+        matches = [(i, s) for i, s in scores[:self.limit] if s > self.threshold]
+
+        return matches
+
+    def find_closest_match(self, text):
+        if (not text) or (text in self.name_set):
+            # text is None or text is already a match
+            closest_text = text
+
+        else:
+            normal = self.normalize(text)
+            matches = self.score(normal, self.get_shortlist(normal)) if len(normal) else []
+            if (len(normal) > self.short_length) and (len(matches) < 2):
+                # a lone match could still have close company off the shortlist, so score every name
+                matches = self.score(normal, range(len(self.names)))
+
+            if len(matches) == 0:
+                # no match
+                closest_text = text
+
+            elif (len(matches) == 1) or (self.similarity == 0):
+                # only one matching result or being forced to choose best match
+                closest_text = self.names[matches[0][0]]
+
+            else:
+                # more than one result and others that are close, so settle it with initials
+                close = [i for i, s in matches if s >= (matches[0][1] - self.similarity)]
+                abbreviation = self.texter.abbreviate_name(text)
+                rematches = self.score(self.normalize(abbreviation), close)
+                # same as before, the initials stand in when none of them are close
+                closest_text = self.names[rematches[0][0]] if len(rematches) else abbreviation
+
+        return closest_text
+
+    def find_in_text(self, text):
+        # earliest name that shows up in the text
+        found = self.pattern.search(text) if (self.pattern and text) else None
+        name = found.group(0) if found else None
+
+        return name
@@ -1,14 +1,36 @@
 ''' Number crunching for round results '''
 
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from pandas import DataFrame
+
 from crunching.comparisons import Members, Pulse
 
+def solve_placement(members_df, distances_df, incremental=False):
+    ''' place members from already fetched data so it can run in a worker process '''
+    xy_ = members_df[['player_id', 'x', 'y']]
+    members = Members(members_df['player_id'])
+
+    pulse = Pulse(distances_df)
+
+    members.update_coordinates(pulse, xy_=xy_, incremental=incremental)
+
+    placement = {'members': members.df, 'optimized': members.coordinates['success'],
+                 'mode': members.coordinates['mode'],
+                 'iterations': members.coordinates['iterations'],
+                 'time': members.coordinates['time']}
+
+    return placement
+
 class Analyzer:
     def __init__(self, database):
         self.database = database
+        self.solves = []
 
-    def place_all(self):
+    def place_all(self, incremental=False, workers=1):
         league_ids = self.database.get_league_ids()
 
+        leagues = {}
         for league_id in league_ids:
             if self.database.check_data(league_id):
                 league_title = self.database.get_league_name(league_id)
@@ -17,19 +39,68 @@ class Analyzer:
                     print(f'Placements for {league_title} already up to date')
 
                 else:
-                    placement = self.place_league(league_id, league_title)
+                    leagues[league_id] = league_title
+
+        if workers > 1:
+            self.place_parallel(leagues, incremental=incremental, workers=workers)
+
+        else:
+            for league_id, league_title in leagues.items():
+                placement = self.place_league(league_id, league_title, incremental=incremental)
+
+                if placement:
+                    self.store_placement(league_id, placement)
+
+        self.print_solves()
+
+    def place_parallel(self, leagues, incremental=False, workers=2):
+        ''' solve each league in its own process and store from here '''
+        print(f'Placing members in {len(leagues)} leagues across {workers} workers')
+
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            # database connections stay in this process, so fetch everything first
+            futures = {}
+            for league_id, league_title in leagues.items():
+                inputs = self.get_inputs(league_id)
+                futures[executor.submit(solve_placement, *inputs, incremental=incremental)] = league_id
+
+            for future in as_completed(futures):
+                league_id = futures[future]
+                league_title = leagues[league_id]
+                try:
+                    placement = future.result()
 
-                    if placement:
-                        self.database.store_members(placement['members'], league_id)
-                        self.database.store_optimizations(league_id, self.version, optimized=placement['optimized'])
-        
-    def place_league(self, league_id, league_title):
+                except Exception as e:
+                    # one league that can't be solved shouldn't hold up the rest
+                    print(f'\t...placement failed for {league_title} due to {e}')
+                    continue
+
+                # storing errors are not the solver's, so they aren't hidden
+                self.solves.append([league_title, placement['mode'], placement['iterations'], placement['time']])
+                self.store_placement(league_id, placement)
+                print(f'\t...placed {league_title}')
+
+    def store_placement(self, league_id, placement):
+        # note which rounds the placement covers
+        round_ids = self.database.get_rounds(league_id)['round_id'].to_list()
+
+        self.database.store_members(placement['members'], league_id)
+        self.database.store_optimizations(league_id, round_ids=round_ids, optimized=placement['optimized'])
+
+    def print_solves(self):
+        # show how long each league took to place
+        if len(self.solves):
+            solves_df = DataFrame(self.solves, columns=['league', 'mode', 'iterations', 'time'])
+            print(f'Placement summary\n{solves_df}')
+
+    def place_league(self, league_id, league_title, incremental=False):
         print(f'Placing members in league {league_title}')
-        
+
         if self.database.check_data(league_id):
             print(f'\t...analyzing {league_title}')
 
-            placement = self.get_placements(league_id)
+            placement = self.get_placements(league_id, incremental=incremental)
+            self.solves.append([league_title, placement['mode'], placement['iterations'], placement['time']])
 
         else:
             print(f'\t...no data for {league_title}')
@@ -37,21 +108,18 @@ class Analyzer:
 
         return placement
 
-    def get_placements(self, league_id):
+    def get_inputs(self, league_id):
+        members_df = self.database.get_members(league_id)
+        distances_df = self.database.get_distances(league_id)
+
+        return members_df, distances_df
+
+    def get_placements(self, league_id, incremental=False):
         # get group pulse
         print('Getting pulse')
         print('\t...coordinates')
 
-        members_df = self.database.get_members(league_id)
-        xy_ = members_df[['player_id', 'x', 'y']]
-        members = Members(members_df)
-
-        distances_df = self.database.get_distances(league_id)
-        pulse = Pulse(distances_df)
-
-        members.update_coordinates(pulse, xy_=xy_)
-        members_df = members.get_members()
-        
-        placement = {'members': members.df, 'optimized': members.coordinates['success']}
+        members_df, distances_df = self.get_inputs(league_id)
+        placement = solve_placement(members_df, distances_df, incremental=incremental)
 
         return placement
\ No newline at end of file
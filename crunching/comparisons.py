@@ -1,10 +1,13 @@
 ''' Round comparisons '''
 
 from itertools import combinations
-from math import pi, sin, cos, log
+from math import pi, log
+from time import perf_counter
 
-from scipy.optimize import minimize
+from scipy.optimize import minimize, OptimizeResult
 from pandas import DataFrame, concat
+from numpy import asarray, triu_indices, where, zeros, bincount, concatenate, fmax, nan_to_num, nan, eye, repeat, tile, \
+    arange, sin, cos
 
 class Patternizer:
     def __init__(self, songs, votes, player_ids):
@@ -21,12 +24,12 @@ class Patternizer:
             columns = ['song_id', 'round_id', 'submitter_id']
             patterns = self.songs.df[columns].merge(patterns, on='song_id', how='left').reindex(columns=columns + self.player_ids)
 
-            average_votes_group_sum = self.votes.df.groupby('song_id').sum().reset_index()
-            average_votes_group_count = self.votes.df.groupby('song_id').count().reset_index()
+            average_votes_group_sum = self.votes.df.groupby('song_id')[['vote']].sum().reset_index()
+            average_votes_group_count = self.votes.df.groupby('song_id')[['vote']].count().reset_index()
             patterns['v_'] = average_votes_group_sum['vote'].div(average_votes_group_count['vote'])
 
-            average_votes_submitter_sum = self.votes.df.groupby(['round_id', 'player_id']).sum().reset_index()
-            average_votes_submitter_count = self.votes.df.groupby(['round_id', 'player_id']).count().reset_index()
+            average_votes_submitter_sum = self.votes.df.groupby(['round_id', 'player_id'])[['vote']].sum().reset_index()
+            average_votes_submitter_count = self.votes.df.groupby(['round_id', 'player_id'])[['vote']].count().reset_index()
             average_votes_submitter = average_votes_submitter_sum.copy()
             average_votes_submitter['vote'] = average_votes_submitter_sum['vote'].div(average_votes_submitter_count['vote'])
             patterns['v^'] = self.songs.df.merge(average_votes_submitter, on='round_id')['vote']
@@ -82,6 +85,65 @@ class Patternizer:
 
         return distance
 
+    def get_distance_matrix(self, group=True):
+        ''' all pairwise (and player to group) distances in one pass '''
+        patterns = self.get_patterns()
+        did_count = self.get_counted().set_index('song_id').reindex(patterns['song_id'])
+
+        player_ids = asarray(self.player_ids)
+        n_players = len(player_ids)
+
+        # song x player arrays
+        V = patterns[self.player_ids].to_numpy(dtype=float)
+        C = did_count[self.player_ids].fillna(False).to_numpy(dtype=bool)
+        S = patterns['submitter_id'].to_numpy()[:, None] == player_ids[None, :]
+        v_hat = patterns['v^'].to_numpy(dtype=float)
+        v_bar = patterns['v_'].to_numpy(dtype=float)
+
+        # each pair's distance sums (pattern1 - pattern2)^2 over songs both counted, where pattern1 is the
+        # player's vote unless the player submitted the song, then it is the higher of v^ and the opponent's vote;
+        # expanding the square leaves only player x player products, so no song x player x player array is built
+        W = C.astype(float)
+        V0 = nan_to_num(V)
+        F = nan_to_num(fmax(v_hat[:, None], V))
+        Z = (S & C).astype(float)
+
+        # as if nobody submitted
+        WV = W * V0
+        WV2 = W * V0**2
+        base = WV2.T @ W + W.T @ WV2 - 2 * WV.T @ WV
+
+        # songs the player submitted swap (V_p - V_q)^2 for (F_q - V_q)^2, and likewise for the opponent
+        submitted = Z.T @ (W * (F - V0)**2) - ((Z * V0**2).T @ W - 2 * (Z * V0).T @ WV + Z.T @ WV2)
+        squares = fmax(base + submitted + submitted.T, 0)
+
+        n_counted = W.T @ W
+        distances = squares**0.5 / where(n_counted > 0, n_counted, 1)
+        distances = where(n_counted > 0, distances, nan)
+
+        off_diagonal = ~eye(n_players, dtype=bool)
+        distances_df = DataFrame({'player_id': repeat(player_ids, n_players)[off_diagonal.ravel()],
+                                  'opponent_id': tile(player_ids, n_players)[off_diagonal.ravel()],
+                                  'distance': distances[off_diagonal]})
+
+        if group:
+            # distance from each player to the group average
+            pattern1_g = where(S, fmax(v_hat, v_bar)[:, None], V)
+            a = where(C, nan_to_num(pattern1_g), 0)
+            b = where(C, nan_to_num(v_bar)[:, None], 0)
+
+            n_counted_g = C.sum(0)
+            distances_g = ((a - b)**2).sum(0)**0.5 / where(n_counted_g > 0, n_counted_g, 1)
+            distances_g = where(n_counted_g > 0, distances_g, nan)
+
+            distances_df = concat([distances_df,
+                                   DataFrame({'player_id': player_ids,
+                                              'opponent_id': None,
+                                              'distance': distances_g})],
+                                  ignore_index=True)
+
+        return distances_df
+
 class Pulse:
     distance_threshold = 0.75
 
@@ -110,6 +172,8 @@ class Pulse:
 
 class Members:
     columns = ['player_id', 'x', 'y']
+    # normalized stress past which a layout is a poor fit (Kruskal)
+    stress_limit = 0.2
 
     def __init__(self, player_ids):
         self.df = DataFrame(columns=self.columns)
@@ -119,7 +183,10 @@ class Members:
         self.player_ids = player_ids
 
         self.coordinates = {'success': False,
-                            'message': None}
+                            'message': None,
+                            'mode': None,
+                            'iterations': 0,
+                            'time': 0}
 
     def __repr__(self):
         printed = self.df.sort_values(['wins', 'dfc'], ascending=[False, True]).dropna(axis='columns', how='all')
@@ -136,6 +203,42 @@ class Members:
             for i in range(len(c)))**0.5
         return difference
 
+    def stress(self, xy, D, N, I, J):
+        # vectorized distdiff, returning the stress and its gradient
+        # first point is fixed at 0,0
+        n_players = int(len(xy)/2) + 1
+        x = concatenate([[0], xy[:n_players-1]])
+        y = concatenate([[0], xy[n_players-1:]])
+
+        dx = x[I] - x[J]
+        dy = y[I] - y[J]
+        d = (dx**2 + dy**2)**0.5
+        r = where(N, d - D, 0)
+
+        difference = (r**2).sum()**0.5
+        if difference == 0:
+            return difference, zeros(len(xy))
+
+        # direction between each pair, with a fixed direction per pair for points on top of each other
+        # so that a pair that should be apart still gets pushed apart
+        spread = arange(len(d))
+        ux = where(d > 0, dx / where(d > 0, d, 1), cos(spread))
+        uy = where(d > 0, dy / where(d > 0, d, 1), sin(spread))
+
+        # d(difference)/d(d) for each pair, spread back onto both players
+        g = r / difference
+        gx = bincount(I, g*ux, n_players) - bincount(J, g*ux, n_players)
+        gy = bincount(I, g*uy, n_players) - bincount(J, g*uy, n_players)
+
+        return difference, concatenate([gx[1:], gy[1:]])
+
+    def normalize_stress(self, difference, D, N):
+        # stress relative to the size of the target distances, so leagues can be compared
+        scale = (where(N, D, 0)**2).sum()**0.5
+        fit = difference / scale if scale > 0 else 0
+
+        return fit
+
     def get_members(self):
         return self.df.reindex(columns=self.columns)
 
@@ -149,11 +252,14 @@ class Members:
 
         seeded = concat([self.df.apply(lambda x: R * cos(angle * (x.name - 1)) if x.name > 0 else 0, axis=1),
                          self.df.apply(lambda x: R * sin(angle * (x.name - 1)) if x.name > 0 else 0, axis=1)],
-                        axis=1)
+                        axis=1, keys=['x', 'y'])
 
-        self.df[['x', 'y']] = self.df.mask(self.df[['x', 'y']].isna().sum(1).ne(0), seeded)[['x', 'y']]
+        # only players without a placement are seeded
+        unplaced = self.df[['x', 'y']].isna().any(axis=1)
+        self.df.loc[unplaced, ['x', 'y']] = seeded.loc[unplaced, ['x', 'y']].values
 
-    def update_coordinates(self, pulse, xy_=None, max_iters=5000):
+    def update_coordinates(self, pulse, xy_=None, max_iters=5000, engine='vectorized',
+                           incremental=False, tolerance=0.1):
         # best fit player nodes
         n_players = len(self.player_ids)
 
@@ -164,6 +270,7 @@ class Members:
 
             self.coordinates['success'] = True
             self.coordinates['message'] = f'trivial case of {n_players} players'
+            self.coordinates['mode'] = 'trivial'
 
         else:
             n = len(self.player_combinations)
@@ -178,18 +285,44 @@ class Members:
             if xy_ is not None:
                 self.df[['x', 'y']] = self.df.drop(columns=[c for c in ['x', 'y'] if c in self.df.columns]).merge(xy_, on='player_id')[['x', 'y']]
 
+            # only warm start when every player already has a stored placement
+            warm_start = incremental and (xy_ is not None) and self.df[['x', 'y']].notna().all().all()
+            if warm_start:
+                # first point is fixed at 0,0
+                self.df[['x', 'y']] = self.df[['x', 'y']] - self.df[['x', 'y']].iloc[0]
+
             ##if self.df[['x', 'y']].isna().all().all():
             self.seed_xy(pulse)
 
             xy0 = self.melt_xy(self.df)
-            print('\t...minimizing')
-            xy = minimize(self.distdiff, xy0, args=(distances['distance'], needed), options={'maxiter': max_iterations})
+            start = perf_counter()
+            if warm_start:
+                print('\t...minimizing moved players')
+                xy = self.minimize_xy_incremental(xy0, distances['distance'], needed, max_iterations, tolerance)
+                mode = 'incremental'
+
+                # pinned players can hold drift from earlier solves, so check the fit as a whole
+                fit = self.normalize_stress(xy.fun, *self.vectorize_distances(distances['distance'], needed)[:2])
+                if (not xy.success) or (fit > self.stress_limit):
+                    print(f'\t...falling back to full solve (fit {fit:.3f})')
+                    xy_full = self.minimize_xy(xy0, distances['distance'], needed, max_iterations, engine=engine)
+                    if xy_full.fun <= xy.fun:
+                        xy = xy_full
+                        mode = 'full'
+
+            else:
+                print('\t...minimizing')
+                xy = self.minimize_xy(xy0, distances['distance'], needed, max_iterations, engine=engine)
+                mode = 'full'
 
             self.df['x'] = [0] + xy.x.tolist()[0:int(len(xy.x)/2)]
             self.df['y'] = [0] + xy.x.tolist()[int(len(xy.x)/2):]
 
             self.coordinates['success'] = xy.success
             self.coordinates['message'] = xy.message
+            self.coordinates['mode'] = mode
+            self.coordinates['iterations'] = xy.get('nit', 0)
+            self.coordinates['time'] = perf_counter() - start
 
             if xy.success:
                 print('\t\t...optimal solution found')
@@ -202,6 +335,73 @@ class Members:
                 improvement = 1 - dist1/dist0
                 print(f'\t\t...improved by {improvement:.2%}')
 
+    def vectorize_distances(self, D, N):
+        # target distances, needed mask and pair indices as arrays
+        I, J = triu_indices(len(self.player_ids), 1)
+        D_v = asarray(D, dtype=float)
+        N_v = asarray(N, dtype=bool) & (D_v == D_v) # drop pairs without a distance
+
+        return where(N_v, D_v, 0), N_v, I, J
+
+    def minimize_xy(self, xy0, D, N, max_iterations, engine='vectorized'):
+        ''' find best fit coordinates with the legacy or vectorized objective '''
+        if engine == 'legacy':
+            xy = minimize(self.distdiff, xy0, args=(D, N), options={'maxiter': max_iterations})
+
+        elif engine == 'vectorized':
+            xy = minimize(self.stress, asarray(xy0, dtype=float), args=self.vectorize_distances(D, N),
+                          jac=True, options={'maxiter': max_iterations})
+
+        return xy
+
+    def get_moved(self, xy, D, N, I, J, tolerance=0.1):
+        # players whose target distances moved away from the current layout
+        n_players = int(len(xy)/2) + 1
+        x = concatenate([[0], xy[:n_players-1]])
+        y = concatenate([[0], xy[n_players-1:]])
+        d = ((x[I] - x[J])**2 + (y[I] - y[J])**2)**0.5
+
+        # average relative change across each player's needed pairs
+        changes = where(N, abs(d - D) / where(D > 0, D, 1), 0)
+        n_pairs = bincount(I, N, n_players) + bincount(J, N, n_players)
+        change = (bincount(I, changes, n_players) + bincount(J, changes, n_players)) / where(n_pairs > 0, n_pairs, 1)
+
+        moved = change > tolerance
+        moved[0] = False # first point stays pinned at 0,0
+
+        return moved
+
+    def stress_subset(self, xy_free, xy, free, D, N, I, J):
+        # stress with pinned players held at their current coordinates
+        xy_full = xy.copy()
+        xy_full[free] = xy_free
+        difference, gradient = self.stress(xy_full, D, N, I, J)
+
+        return difference, gradient[free]
+
+    def minimize_xy_incremental(self, xy0, D, N, max_iterations, tolerance=0.1):
+        ''' only move players whose distances changed, pinning everyone else '''
+        xy = asarray(xy0, dtype=float)
+        D_v, N_v, I, J = self.vectorize_distances(D, N)
+        moved = self.get_moved(xy, D_v, N_v, I, J, tolerance=tolerance)
+
+        if moved.sum():
+            print(f'\t\t...{moved.sum()} of {len(moved)} players moved')
+            free = concatenate([moved[1:], moved[1:]])
+            xy_free = minimize(self.stress_subset, xy[free], args=(xy, free, D_v, N_v, I, J),
+                               jac=True, options={'maxiter': max_iterations})
+
+            xy_result = xy.copy()
+            xy_result[free] = xy_free.x
+            xy_free.x = xy_result
+
+        else:
+            # nothing moved, keep the stored layout
+            xy_free = OptimizeResult(x=xy, fun=self.stress(xy, D_v, N_v, I, J)[0], success=True,
+                                     message='no players moved', nit=0)
+
+        return xy_free
+
     def melt_xy(self, df):
-        xy = df[['x','y']][1:].fillna(0).melt()['value']
+        xy = df[['x','y']][1:].astype(float).fillna(0).melt()['value']
         return xy
\ No newline at end of file
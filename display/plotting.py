@@ -118,6 +118,22 @@ class Plotter(Streamable):
 
         return df
 
+    def prefetch_dfs(self, league_id):
+        ''' load every league dataframe not already in session state in one go '''
+        names = ['boards_df', 'creators_winners_df', 'competitions_df', 'rankings_df',
+                 'awards_round_df', 'awards_league_df', 'features_df', 'mappings_df',
+                 'genres_df', 'categories_df', 'tags_df', 'exclusives_df',
+                 'results_df', 'descriptions_df', 'playlists_df', 'duration']
+
+        missing = [name for name in names if not self.streamer.get_session_state((name, league_id))[1]]
+        if len(missing):
+            try:
+                bundle = self.database.get_league_bundle(league_id, player_id=self.view_player, names=missing)
+                for name in bundle:
+                    self.streamer.store_session_state((name, league_id), bundle[name])
+            except Exception as e:
+                self.print_error(f'{self.prefetch_dfs.__name__}', e)
+
     def plot_try(self, plot_function, exception=Exception, **kwargs):
         exception = exception if exception else PPRError 
 
@@ -132,30 +148,35 @@ class Plotter(Streamable):
                 
     def get_name(self, name_id, table=None, clean=False, full=False, display=False, feel=False, placeholder=None):
         if isinstance(name_id, (list, ndarray, Index)):
-            name = [self.get_name(n_id, table, clean, full, display) for n_id in name_id]
+            # look up all names in one pass
+            n_ids = [n_id for n_id in name_id if not self.is_blank_name(n_id)]
+            names = dict(zip(n_ids, self.database.get_names(n_ids, table)))
+            name = [self.format_name(names[n_id], clean, full, display) if n_id in names else n_id for n_id in name_id]
 
         else:
-            if (not name_id) or (isinstance(name_id, str) and ((len(name_id) == 0) or (name_id == placeholder))):
+            if self.is_blank_name(name_id, placeholder):
                 name = name_id
 
             else:
-                name = {'player': self.database.get_player_name,
-                        'round': self.database.get_round_name,
-                        'league': self.database.get_league_name,
-                        'competition': self.database.get_competition_name,
-                        }[table](name_id)
+                name = self.format_name(self.database.get_name(name_id, table), clean, full, display, feel)
+
+        return name
+
+    def is_blank_name(self, name_id, placeholder=None):
+        return (not name_id) or (isinstance(name_id, str) and ((len(name_id) == 0) or (name_id == placeholder)))
 
-                if clean:
-                    name = self.texter.clean_text(name)
+    def format_name(self, name, clean=False, full=False, display=False, feel=False):
+        if clean:
+            name = self.texter.clean_text(name)
 
-                if full:
-                    name = self.texter.get_display_name_full(name)
+        if full:
+            name = self.texter.get_display_name_full(name)
 
-                if display:
-                    name = self.texter.get_display_name(name)
+        if display:
+            name = self.texter.get_display_name(name)
 
-                if feel:
-                    name = self.library.feel_title(self.texter.clean_text(name))
+        if feel:
+            name = self.library.feel_title(self.texter.clean_text(name))
 
         return name
 
@@ -282,6 +303,7 @@ class Plotter(Streamable):
                 self.plot_title(league_id, league_creator)
           
                 # load dataframes
+                self.prefetch_dfs(league_id)
                 boards_df = self.prepare_dfs(('boards_df', league_id),
                                              self.database.get_boards, league_id)
                 creators_winners_df = self.prepare_dfs(('creators_winners_df', league_id),
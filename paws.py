@@ -1,7 +1,10 @@
 ''' Updates from MusicLeague and analyzes data '''
 
+from os import cpu_count
+
 import display.printing
 from common.data import Database
+from common.calling import Caller, Cacher
 from preparing.messenger import GMailer
 from preparing.update import Updater, Musician
 from crunching.analyze import Analyzer
@@ -15,7 +18,7 @@ def check_for_updates(gmailer):
 def update_web_data(database, league_ids=None):
     ''' extract data from MusicLeague '''
     updater = Updater(database)
-    updater.update_musicleague(league_ids=league_ids)
+    updater.update_musicleague(league_ids=league_ids, workers=4, stream=True)
 
 def update_api_data(database):
     ''' enhance data with Spotify and LastFM '''
@@ -27,19 +30,27 @@ def update_api_data(database):
 def place_data(database):
     ''' analyze MusicLeague data '''
     analyzer = Analyzer(database)
-    analyzer.place_all()
+    analyzer.place_all(incremental=True, workers=cpu_count() or 1)
 
 def output_playlists(database, league_ids=None):
     ''' update Spotify playlists '''
     musician = Musician(database)
     musician.output_playlists(league_ids=league_ids)
 
+def refresh_views(database):
+    ''' bring materialized views up to date after storing '''
+    database.materialize()
+
 def close_out(gmailer):
     ''' don't need to check mail again ''' 
     gmailer.mark_as_read()
 
 def main():
+    # reuse unchanged API responses from earlier runs
+    Caller.cacher = Cacher()
+
     # prepare database
+    ## upsert_engine='copy' or 'params' once ON CONFLICT has been checked against every table's unique keys
     database = Database()
     
     # check messages
@@ -50,9 +61,11 @@ def main():
     if league_ids:
         # update data in database from MusicLeague webpage
         update_web_data(database, league_ids=league_ids)
+        refresh_views(database)
 
         # update data in database from Spotify and LastFM APIs
         update_api_data(database)
+        refresh_views(database)
 
         ### output Spotify playlists
         ##output_playlists(database, league_ids=league_ids)
@@ -62,6 +75,12 @@ def main():
 
     # place data from rounds
     place_data(database)
+    refresh_views(database)
+
+    # show time spent waiting on APIs
+    database.print_timings()
+    Caller.cacher.print_counts()
+    Caller.cacher.write_version()
         
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -3,6 +3,7 @@
 from datetime import datetime, timedelta
 from math import ceil
 import time
+from concurrent.futures import ThreadPoolExecutor
 from base64 import b64encode
 from urllib import parse
 
@@ -17,7 +18,8 @@ from common.secret import get_secret
 from common.words import Texter
 from common.locations import MOSAIC_URL, SPOTIFY_AUTH_URL, SPOTIFY_REDIRECT, LASTFM_URL, WIKI_URL
 from common.structure import SPOTIFY_USER_ID
-from common.calling import Caller
+from common.calling import Caller, Limiter
+from preparing.extract import Stripper
 from display.media import Gallery, Byter
 from display.storage import Boxer, GImager
 from display.streaming import Streamable
@@ -35,6 +37,12 @@ class Spotter(Streamable, Caller):
                       'valence',
                       'tempo']
 
+    # most ids each endpoint accepts in one call
+    batch_sizes = {'tracks': 50,
+                   'artists': 50,
+                   'albums': 20,
+                   'audio_features': 100}
+
     def __init__(self, streamer=None):
         super().__init__()
         self.sp = None
@@ -83,8 +91,9 @@ class Spotter(Streamable, Caller):
                           auth_manager=auth_manager)
 
     def get_track_elements(self, uri):
-        results = self.sp.track(uri)
+        return self.extract_track_elements(self.sp.track(uri))
 
+    def extract_track_elements(self, results):
         elements = {'uri': results['uri'],
                     'name': results['name'],
                     'artist_uri': [artist['uri'] for artist in results['artists']],
@@ -95,8 +104,9 @@ class Spotter(Streamable, Caller):
         return elements
 
     def get_artist_elements(self, uri):
-        results = self.sp.artist(uri)
+        return self.extract_artist_elements(self.sp.artist(uri))
 
+    def extract_artist_elements(self, results):
         elements = {'uri': results['uri'],
                     'name': results['name'],
                     'genres': results['genres'],
@@ -107,8 +117,9 @@ class Spotter(Streamable, Caller):
         return elements
 
     def get_album_elements(self, uri):
-        results = self.sp.album(uri)
+        return self.extract_album_elements(self.sp.album(uri))
 
+    def extract_album_elements(self, results):
         elements = {'uri': results['uri'],
                     'name': results['name'],
                     'genres': results['genres'],
@@ -162,13 +173,23 @@ class Spotter(Streamable, Caller):
         return elements
 
     def get_audio_features(self, uri):
-        results = self.sp.audio_features(uri)
+        return self.extract_audio_features(self.sp.audio_features(uri)[0])
 
-        features = {key: results[0][key] for key in self.audio_features}
-        features['duration'] = results[0]['duration_ms'] / 1000 / 60
+    def extract_audio_features(self, results):
+        features = {key: results[key] for key in self.audio_features}
+        features['duration'] = results['duration_ms'] / 1000 / 60
 
         return features
 
+    def get_tracks(self, uris):
+        return self.sp.tracks(uris)['tracks']
+
+    def get_artists(self, uris):
+        return self.sp.artists(uris)['artists']
+
+    def get_albums(self, uris):
+        return self.sp.albums(uris)['albums']
+
     def update_database(self, database):
         self.database = database
         
@@ -206,6 +227,27 @@ class Spotter(Streamable, Caller):
 
         return df_update
 
+    def get_batch_updates(self, df, fetch, extract, size, key='uri'):
+        ''' look up many ids per call and map the results back by id '''
+        df_update = df.copy()
+
+        uris = df_update[key].drop_duplicates().to_list()
+        elements = {}
+        for i in range(ceil(len(uris)/size)):
+            uris_segment = uris[i*size:(i+1)*size]
+            # results come back in the order requested, with None for unknown ids
+            results = fetch(uris_segment)
+            elements.update({uri: extract(result) for uri, result in zip(uris_segment, results) if result})
+
+        # leave rows that weren't found as they were
+        found = df_update[key].isin(elements.keys())
+        if found.any():
+            df_elements = [elements[uri] for uri in df_update.loc[found, key]]
+            df_to_update = DataFrame(df_elements, index=df_update[found].index)
+            df_update.loc[found, df_to_update.columns] = df_to_update
+
+        return df_update
+
     def update_db_players(self):
         self.streamer.print('\t...updating user information')
         players_db = self.database.get_players_update_sp()
@@ -233,8 +275,10 @@ class Spotter(Streamable, Caller):
         tracks_db = self.database.get_tracks_update_sp()
         
         if len(tracks_db):
-            tracks_update_1 = self.get_updates(tracks_db, self.get_track_elements, key='uri')
-            tracks_update_2 = self.get_updates(tracks_db, self.get_audio_features, key='uri')
+            tracks_update_1 = self.get_batch_updates(tracks_db, self.get_tracks, self.extract_track_elements,
+                                                     self.batch_sizes['tracks'])
+            tracks_update_2 = self.get_batch_updates(tracks_db, self.sp.audio_features, self.extract_audio_features,
+                                                     self.batch_sizes['audio_features'])
             tracks_update = tracks_update_1.merge(tracks_update_2, on='uri')
             self.database.store_tracks(tracks_update)
 
@@ -244,7 +288,8 @@ class Spotter(Streamable, Caller):
         
         if len(artists_db):
             ## note that some artists don't have images on Spotify -- should these be left blank permanently?
-            artists_update = self.get_updates(artists_db, self.get_artist_elements)
+            artists_update = self.get_batch_updates(artists_db, self.get_artists, self.extract_artist_elements,
+                                                    self.batch_sizes['artists'])
             self.database.store_artists(artists_update)
 
     def update_db_albums(self):
@@ -252,7 +297,8 @@ class Spotter(Streamable, Caller):
         albums_db = self.database.get_albums_update_sp()
 
         if len(albums_db):
-            albums_update = self.get_updates(albums_db, self.get_album_elements)
+            albums_update = self.get_batch_updates(albums_db, self.get_albums, self.extract_album_elements,
+                                                   self.batch_sizes['albums'])
             self.database.store_albums(albums_update)  
 
     def update_db_genres(self):
@@ -459,11 +505,23 @@ class Spotter(Streamable, Caller):
         self.sp.playlist_replace_items(playlist_uri, track_uris)
 
 class FMer(Streamable, Caller):
+    # LastFM allows about 5 calls per second averaged over 5 minutes
+    rate_limit = 5
+    # tries made here under the rate limiter, kept apart from the HTTP retry settings in Caller
+    fm_retries = 3
+    # errors LastFM reports in the body that are worth trying again
+    retry_errors = [11, 16, 29]
+    # seconds to reuse cached track info when response caching is on
+    cache_ttl = 7*24*60*60
+
     def __init__(self, streamer=None):
         super().__init__()
         self.fm = None
         self.add_streamer(streamer)
         self.api_key = get_secret('LASTFM_API_KEY')
+        self.limiter = Limiter(rate=self.rate_limit)
+        # titles are cleaned the same way tracks are
+        self.stripper = Stripper()
 
     def call_api(self, artist=None, title=None):
         if artist and not title:
@@ -480,7 +538,13 @@ class FMer(Streamable, Caller):
             url += f'&artist={parse.quote(artist)}' if artist else ''
             url += f'&track={parse.quote(title)}' if title else ''
             
-            content, jason = self.invoke_api(url, method='get')
+            for attempt in range(self.fm_retries + 1):
+                # retries go to LastFM rather than the cache, and each one waits its turn with the limiter
+                content, jason = self.invoke_api(url, method='get', limiter=self.limiter, retries=0, ttl=self.cache_ttl,
+                                                 cacheable=self.is_cacheable, refresh=(attempt > 0))
+                if not (self.is_retryable(jason) and (attempt < self.fm_retries)):
+                    break
+                time.sleep(self.get_backoff(attempt))
             ##response = requests.get(url)
             ##if response.ok:
             ##    content = response.content
@@ -492,22 +556,25 @@ class FMer(Streamable, Caller):
 
         return content, jason
 
+    def is_retryable(self, jason):
+        # failed calls and busy errors are tried again
+        return (jason is None) or (jason.get('error') in self.retry_errors)
+
+    def is_cacheable(self, content, jason):
+        # LastFM sends errors with a 200, so only keep answers without one
+        return not (jason and jason.get('error'))
+
     def clean_title(self, title):
         # remove featuring artists and pull remixes
-        self.texter = Texter()
+        title, mix = self.stripper.clean_title(title)
 
-        title, mix1 = self.texter.remove_parenthetical(title, ['Remix', 'Mix'], position='end', case_sensitive=True)
-        title, mix2 = self.texter.remove_parenthetical(title, ['Remix', 'Mix'], parentheses=[['- ', '$']], position='end', case_sensitive=True)
-        title, _ = self.texter.remove_parenthetical(title, ['with ', 'Duet with '], position='start') #<- should with only be for []?
-        title, _ = self.texter.remove_parenthetical(title, ['feat'], position='start') # there can be with and feat together
-        title, _ = self.texter.remove_parenthetical(title, ['Live '], position='start', parentheses=[['- ', '$']], middle=[' with '])
-        title, _ = self.texter.remove_parenthetical(title, ['feat. '], position='start', parentheses=[['', '$']])
-        title = self.texter.drop_dash(title)
+        return title, mix
 
-        mixes = [m for m in filter(None, [mix1, mix2])]
-        mix = mixes[0] if len(mixes) else None
+    def clean_titles(self, titles):
+        # a whole column at once
+        titles_df = self.stripper.clean_titles(titles)
 
-        return title, mix
+        return titles_df
     
     def get_track_info(self, artist, title, max_tags=5):
         self.streamer.print(f'\t...{artist} - {title}')
@@ -531,25 +598,29 @@ class FMer(Streamable, Caller):
 
         self.update_db_tracks()
 
-    def update_db_tracks(self):
+    def update_db_tracks(self, workers=8):
         self.streamer.print('Connecting to LastFM API...')
         self.streamer.print('\t...updating track information')
         tracks_update_db = self.database.get_tracks_update_fm()
 
         if len(tracks_update_db):
             # get LastFM elements
-            # limit how many are updated in one go to keep under rate limites
+            # calls run side by side under the rate limiter and each segment is stored as soon as it finishes
             segment_size = 50
-            for tracks_update_db_segment in [tracks_update_db.loc[i*segment_size:(i+1)*segment_size-1].copy() \
-                                            for i in range(ceil(len(tracks_update_db)/segment_size))]:
-                df_elements = [self.get_track_info(artist, title) for artist, title in tracks_update_db_segment[['artist', 'title']].values]
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                for tracks_update_db_segment in [tracks_update_db.loc[i*segment_size:(i+1)*segment_size-1].copy() \
+                                                for i in range(ceil(len(tracks_update_db)/segment_size))]:
+                    df_elements = list(executor.map(self.get_track_info, tracks_update_db_segment['artist'],
+                                                    tracks_update_db_segment['title']))
 
-                df_to_update = DataFrame(df_elements, index=tracks_update_db_segment.index)
-                tracks_update_db_segment.loc[:, df_to_update.columns] = df_to_update
-                self.database.store_tracks(tracks_update_db_segment)
+                    df_to_update = DataFrame(df_elements, index=tracks_update_db_segment.index)
+                    tracks_update_db_segment.loc[:, df_to_update.columns] = df_to_update
+                    self.database.store_tracks(tracks_update_db_segment)
 
 class Wikier(Streamable, Caller):
     wiki_page = 'list_of_music_genres_and_styles'
+    # seconds to reuse the cached genres page when response caching is on
+    cache_ttl = 24*60*60
 
     def __init__(self):
         super().__init__()
@@ -562,7 +633,7 @@ class Wikier(Streamable, Caller):
 
         url = f'{WIKI_URL}/w/api.php?' + '&'.join(f'{k}={payload[k]}' for k in payload)
 
-        content, jason = self.invoke_api(url, method='get')
+        content, jason = self.invoke_api(url, method='get', ttl=self.cache_ttl)
 
         ##try:
         ##    response = requests.get(url)
@@ -6,9 +6,10 @@ from zipfile import ZipFile
 from datetime import datetime, timedelta
 import re
 import json
+from hashlib import sha256
 
 import requests
-from pandas import read_csv, DataFrame, concat
+from pandas import read_csv, DataFrame, Series, concat, to_datetime, factorize
 from bs4 import BeautifulSoup
 
 from common.secret import get_secret
@@ -18,19 +19,27 @@ from common.locations import APP_URL, ML_COOKIE_NAME
 from display.streaming import Streamable
 
 class Scraper(Streamable, Caller):
+    # seconds to reuse a cached round listing when response caching is on
+    rounds_ttl = 5*60
+
     def __init__(self):
         super().__init__()
         
         self.cj = {ML_COOKIE_NAME: get_secret('ML_COOKIE_VALUE')}
         
-    def call_api(self, method, player_id=None, league_id=None, round_id=None, end=None, jason=None):      
+    def get_url(self, player_id=None, league_id=None, round_id=None, end=None):
         url = f'{APP_URL}/api/v1'
         url += f'/users/{player_id}' if player_id else ''
         url += f'/leagues/{league_id}'if league_id else ''
         url += f'/rounds/{round_id}' if round_id else ''
         url += f'/{end}' if end else ''
 
-        content, jason = self.invoke_api(url, method=method, cookies=self.cj, json=jason)
+        return url
+
+    def call_api(self, method, player_id=None, league_id=None, round_id=None, end=None, jason=None, ttl=None):      
+        url = self.get_url(player_id=player_id, league_id=league_id, round_id=round_id, end=end)
+
+        content, jason = self.invoke_api(url, method=method, cookies=self.cj, json=jason, ttl=ttl)
 
         return content, jason
 
@@ -51,18 +60,26 @@ class Scraper(Streamable, Caller):
         self.call_api('put', league_id=league_id, round_id=round_id, jason=round_jason)
 
     def get_round_details(self, league_id):
-        _, round_jason = self.call_api('get', league_id=league_id, end='rounds')
+        _, round_jason = self.call_api('get', league_id=league_id, end='rounds', ttl=self.rounds_ttl)
         return round_jason
 
     def get_outstanding(self, league_id, round_id, period):
         _, standing_jason = self.call_api('get', league_id=league_id, round_id=round_id, end=f'{period}s')
         return standing_jason
         
-    def get_data_zip(self, league_id):
+    def get_data_zip(self, league_id, stream=False):
         ''' get zipped CSV files of all exported league data '''
-        r_content, _ = self.call_api('post', league_id=league_id, end='data')
+        if stream:
+            # large exports spill to disk instead of memory
+            r_file = self.download_api(self.get_url(league_id=league_id, end='data'), method='post', cookies=self.cj)
+            r_content = None
+        else:
+            r_file = None
+            r_content, _ = self.call_api('post', league_id=league_id, end='data')
         
-        if r_content:
+        if r_file:
+            item = ZipFile(r_file)
+        elif r_content:
             item = ZipFile(BytesIO(r_content))
         else:
             item = None
@@ -87,6 +104,8 @@ class Scraper(Streamable, Caller):
 class Stripper(Streamable):  
     timestring = '%Y-%m-%dT%H:%M:%SZ'
     timestring2 = timestring.replace('%SZ', '%S.%fZ')
+    iso_pattern = r'\d{4}-\d{2}-\d{2}(?:[T ](?:[01]\d|2[0-3]):[0-5]\d(?::[0-5]\d(?:\.\d+)?)?(?:Z|[+-](?:[01]\d|2[0-3]):?[0-5]\d)?)?'
+    sheets = ['competitors', 'rounds', 'submissions', 'votes']
     '''
     round parameters:
         'completed'
@@ -125,56 +144,140 @@ class Stripper(Streamable):
 
         self.texter = Texter()
 
+    def fingerprint_zip(self, data_zip, chunk_size=2**20):
+        ''' hash each sheet in an export to tell if anything changed '''
+        fingerprint = {}
+        for fn in self.sheets:
+            hasher = sha256()
+            with data_zip.open(f'{fn}.csv') as f:
+                for chunk in iter(lambda: f.read(chunk_size), b''):
+                    hasher.update(chunk)
+            fingerprint[fn] = hasher.hexdigest()
+
+        return fingerprint
+
     def unzip_results(self, data_zip):
-        sheets = ['competitors', 'rounds', 'submissions', 'votes']
         dfs = {}
         with data_zip as z:
-            for fn in sheets:
+            for fn in self.sheets:
                 with z.open(f'{fn}.csv') as f:
                     dfs[fn] = read_csv(f)
 
         # clean up players
-        players = dfs['competitors'].rename(columns={'ID': 'player_id', 'Name': 'player_name'})
+        players = self.clean_players(dfs['competitors'])
 
         # check for data
         if len(dfs['rounds']):
+            rounds = self.clean_rounds(dfs['rounds'])
+            songs = self.clean_songs(dfs['submissions'], players, rounds)
+            votes = self.clean_votes(dfs['votes'], players, rounds, songs)
+            tracks = self.get_tracks(songs)
+            
+            return players, rounds, songs, votes, tracks
 
-            # clean up rounds
-            rounds = dfs['rounds'].rename(columns={'ID': 'round_id', 'Name': 'round_name', 
-                                                   'Description': 'description', 'Playlist URL': 'playlist_url'})
-        
-            rounds.loc[:, 'created_date'] = rounds.apply(lambda x: parse(x['Created']).date(),
-                                                 axis=1)
-        
-            # clean up songs
-            songs = dfs['submissions'].rename(columns={'Submitter ID': 'player_id', 'Round ID': 'round_id',
-                                                       'Spotify URI': 'track_uri', 'Comment': 'comment',
-                                                       'Created': 'Created_s'})        
-            songs.loc[:, 'song_id'] = songs.index
-            songs = songs.merge(players, on=['player_id']).merge(rounds, on=['round_id']).rename(columns={'player_id': 'submitter_id'})
-            songs.loc[:, 'created_date'] = songs.apply(lambda x: parse(x['Created_s']).date(),
-                                        axis=1)
-
-            # clean up votes
-            votes = dfs['votes'].rename(columns={'Voter ID': 'player_id', 'Round ID': 'round_id', 'Points Assigned': 'vote',
-                                                 'Spotify URI': 'track_uri', 'Comment': 'comment',
-                                                 'Created': 'Created_v'})
-            votes = votes.merge(players, on=['player_id']).merge(rounds, on=['round_id']).merge(songs.drop(columns=['comment']), on=['round_id', 'track_uri'])
-            votes.loc[:, 'created_date'] = votes.apply(lambda x: parse(x['Created_v']).date(),
-                            axis=1)
-
-            # drop columns
-            players = players[['player_id', 'player_name']]
-            rounds = rounds[['round_id', 'round_name', 'description', 'playlist_url', 'created_date']]
-            songs = songs[['round_id', 'song_id', 'submitter_id', 'track_uri', 'comment', 'created_date']]
-            votes = votes[['player_id', 'song_id', 'vote', 'comment', 'created_date']] ##[votes['vote']!=0]
-            tracks = songs[['track_uri']].rename(columns={'track_uri': 'uri'}).drop_duplicates()
+        else:
+            self.streamer.print('\t...league results are empty')
+
+    def stream_results(self, data_zip, chunksize=50000):
+        ''' read an export a chunk at a time, leaving votes to be read as they are stored '''
+        with data_zip.open('competitors.csv') as f:
+            players = self.clean_players(read_csv(f))
+        with data_zip.open('rounds.csv') as f:
+            rounds = read_csv(f)
+
+        # check for data
+        if len(rounds):
+            rounds = self.clean_rounds(rounds)
+
+            # songs are needed whole to match votes, but only the kept columns are held
+            with data_zip.open('submissions.csv') as f:
+                songs = concat([self.clean_songs(chunk, players, rounds, reset_index=False) \
+                                for chunk in read_csv(f, chunksize=chunksize)], ignore_index=True)
+            tracks = self.get_tracks(songs)
+
+            votes = self.stream_votes(data_zip, players, rounds, songs, chunksize=chunksize)
             
             return players, rounds, songs, votes, tracks
 
         else:
+            self.close_zip(data_zip)
             self.streamer.print('\t...league results are empty')
 
+    def stream_votes(self, data_zip, players, rounds, songs, chunksize=50000):
+        ''' yield normalized batches of votes '''
+        try:
+            with data_zip.open('votes.csv') as f:
+                for chunk in read_csv(f, chunksize=chunksize):
+                    yield self.clean_votes(chunk, players, rounds, songs)
+        finally:
+            self.close_zip(data_zip)
+
+    def close_zip(self, data_zip):
+        ''' close an export along with the file it was downloaded to '''
+        # ZipFile leaves files it was handed open
+        r_file = data_zip.fp
+        data_zip.close()
+        if r_file is not None:
+            r_file.close()
+
+    def clean_players(self, competitors):
+        players = competitors.rename(columns={'ID': 'player_id', 'Name': 'player_name'})[['player_id', 'player_name']]
+
+        return players
+
+    def clean_rounds(self, rounds):
+        rounds = rounds.rename(columns={'ID': 'round_id', 'Name': 'round_name', 
+                                        'Description': 'description', 'Playlist URL': 'playlist_url'})
+        rounds.loc[:, 'created_date'] = self.parse_dates(rounds['Created'])
+        rounds = rounds[['round_id', 'round_name', 'description', 'playlist_url', 'created_date']]
+
+        return rounds
+
+    def clean_songs(self, submissions, players, rounds, reset_index=True):
+        # keep only songs from known players and rounds
+        songs = submissions.rename(columns={'Submitter ID': 'player_id', 'Round ID': 'round_id',
+                                            'Spotify URI': 'track_uri', 'Comment': 'comment'})
+        # song_id is the row number in the export, which carries across chunks
+        songs.loc[:, 'song_id'] = songs.index
+        songs = songs[songs['player_id'].isin(players['player_id']) & songs['round_id'].isin(rounds['round_id'])]\
+            .rename(columns={'player_id': 'submitter_id'})
+        if reset_index:
+            songs = songs.reset_index(drop=True)
+        songs.loc[:, 'created_date'] = self.parse_dates(songs['Created'])
+        songs = songs[['round_id', 'song_id', 'submitter_id', 'track_uri', 'comment', 'created_date']]
+
+        return songs
+
+    def clean_votes(self, votes, players, rounds, songs):
+        # keep only votes from known players and rounds, joining to songs once
+        votes = votes.rename(columns={'Voter ID': 'player_id', 'Round ID': 'round_id', 'Points Assigned': 'vote',
+                                      'Spotify URI': 'track_uri', 'Comment': 'comment'})
+        votes = votes[votes['player_id'].isin(players['player_id']) & votes['round_id'].isin(rounds['round_id'])]\
+            .merge(songs[['round_id', 'track_uri', 'song_id']], on=['round_id', 'track_uri'])
+        votes.loc[:, 'created_date'] = self.parse_dates(votes['Created'])
+        votes = votes[['player_id', 'song_id', 'vote', 'comment', 'created_date']] ##[votes['vote']!=0]
+
+        return votes
+
+    def get_tracks(self, songs):
+        tracks = songs[['track_uri']].rename(columns={'track_uri': 'uri'}).drop_duplicates()
+
+        return tracks
+
+    def parse_dates(self, created):
+        ''' get dates from export timestamps, as written and without converting time zones '''
+        # only whole, valid ISO timestamps take the fast way
+        text = created.astype(str)
+        dates = to_datetime(text.str[:10].where(text.str.fullmatch(self.iso_pattern)), format='%Y-%m-%d', errors='coerce')
+
+        # anything else goes the slow way, so bad dates fail like they always have
+        unparsed = dates.isna() & created.notna()
+        dates = dates.dt.date.astype(object)
+        if unparsed.any():
+            dates[unparsed] = created[unparsed].apply(lambda x: parse(x).date())
+
+        return dates
+
     def extract_my_leagues(self, leagues_jason):
         ''' turn raw league data into dataframe '''
         leagues_df = DataFrame([[l['id'],
@@ -251,11 +354,53 @@ class Stripper(Streamable):
     def clean_tracks(self, tracks_df):
         # strip featured artists and remix call outs from track title
         ## add binary for Remix status?
-        tracks_df[['title', 'mix']] = tracks_df.apply(lambda x: self.clean_title(x['unclean']),
-                                                      axis=1, result_type='expand')
+        tracks_df[['title', 'mix']] = self.clean_titles(tracks_df['unclean'])
 
         return tracks_df
 
+    def clean_titles(self, titles):
+        ''' remove featuring artists and pull remixes from a column of titles '''
+        texter = self.texter
+        # work out each distinct title once
+        index = titles.index
+        codes, distinct = factorize(titles.astype(object))
+        titles = Series(distinct, dtype=object)
+
+        # remove remixes
+        original_titles = titles
+        titles, mix1 = texter.remove_parentheticals(titles, ['Remix', 'Mix'], position='end', case_sensitive=True)
+        titles, mix2 = texter.remove_parentheticals(titles, ['Remix', 'Mix'], position='end', parentheses=[['- ', '$']], case_sensitive=True)
+        titles, mix3 = texter.remove_parentheticals(titles, ['Remix', 'Mix'], position='end', parentheses=[['- ', ';']], case_sensitive=True)
+
+        # first mix that isn't blank
+        mixes = mix1.where(mix1 != '').fillna(mix2.where(mix2 != '')).fillna(mix3.where(mix3 != ''))
+        # leftover hash
+        mixes = mixes.where(~mixes.str.endswith('-', na=False), mixes.str[:-1])
+        # default remix
+        mixes = mixes.mask(self.is_changed(titles, original_titles) & ~self.has_mix(mixes), '< remix >')
+
+        # remove live versions
+        original_titles = titles
+        titles, _ = texter.remove_parentheticals(titles, ['Live'], position='start', parentheses=[['- ', '$']], middle=[' with '])
+        titles, _ = texter.remove_parentheticals(titles, ['Live'], position='end', parentheses=[['- ', '$']], case_sensitive=True)
+        titles, _ = texter.remove_parentheticals(titles, ['Live'], position='start', case_sensitive=True)
+        # default remix
+        mixes = mixes.mask(self.is_changed(titles, original_titles) & ~self.has_mix(mixes), '< live >')
+
+        # remove featured artists
+        titles, _ = texter.remove_parentheticals(titles, ['with ', 'Duet with '], position='start') ##<- should with only be for []?
+        titles, _ = texter.remove_parentheticals(titles, ['feat'], position='start') # there can be with and feat together
+        titles, _ = texter.remove_parentheticals(titles, ['feat. '], position='start', parentheses=[['', '$']])
+        
+        # remove radio edit and remasters
+        titles = titles.map(lambda x: texter.drop_dash(x) if isinstance(x, str) else x)
+
+        # back to one row per title, where missing titles clean to nothing
+        titles_df = DataFrame({'title': titles, 'mix': mixes}).reindex(codes).astype(object)
+        titles_df = titles_df.where(titles_df.notna(), None).set_index(index)
+
+        return titles_df
+
     def clean_title(self, title):
         ''' remove featuring artists and pull remixes '''
         # remove remixes
@@ -288,10 +433,16 @@ class Stripper(Streamable):
         title, _ = self.texter.remove_parenthetical(title, ['feat. '], position='start', parentheses=[['', '$']])
         
         # remove radio edit and remasters
-        title = self.texter.drop_dash(title)
+        title = self.texter.drop_dash(title) if isinstance(title, str) else title
 
         return title, mix
 
+    def is_changed(self, titles, original_titles):
+        return titles.ne(original_titles) & original_titles.notna()
+
+    def has_mix(self, mixes):
+        return mixes.notna() & (mixes != '')
+
     def extract_wiki_list(self, genres_text):
         # get article text
         noodles = genres_text['parse']['text']['*']
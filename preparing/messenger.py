@@ -16,6 +16,9 @@ from common.calling import Recorder
 
 class GMailer(Caller):
     complete_phrase = 'The Votes Are In'
+    league_pattern = re.compile('round of the(.*?)league')
+    # Gmail suggests no more than 50 calls per batch
+    batch_size = 50
 
     def __init__(self, database, alias=None):
         super().__init__()
@@ -70,6 +73,8 @@ class GMailer(Caller):
 
         with build('gmail', 'v1', credentials=self.credentials) as service:
             messages = service.users().messages().list(userId=self.user_id, q=query).execute()
+            message_ids = [m['id'] for m in messages.get('messages', [])]
+            snippets = self.get_snippets(service, message_ids)
 
         update_needed = (messages['resultSizeEstimate'] > 0)
         league_ids = None
@@ -78,13 +83,7 @@ class GMailer(Caller):
             print('\t...no new messages.')
             self.mark_as_read()
         else:
-            message_leagues = []
-            with build('gmail', 'v1', credentials=self.credentials) as service:
-                for m in messages['messages']:
-                    mail = service.users().messages().get(userId=self.user_id, id=m['id']).execute()
-                    s = re.search('round of the(.*?)league', mail['snippet'])
-                    if len(s.groups()):
-                        message_leagues.append(s.group(1).strip())
+            message_leagues = self.extract_leagues(snippets)
 
             if len(message_leagues):
                 leagues_df = self.database.get_leagues()
@@ -98,5 +97,35 @@ class GMailer(Caller):
 
         return league_ids
 
+    def get_snippets(self, service, message_ids):
+        ''' fetch only the snippet of each message, many per request '''
+        snippets = []
+
+        def add_snippet(request_id, response, exception):
+            if exception is None:
+                snippets.append(response['snippet'])
+            else:
+                print(f'\t...message {request_id} failed due to {exception}')
+
+        for i in range(0, len(message_ids), self.batch_size):
+            batch = service.new_batch_http_request(callback=add_snippet)
+            for message_id in message_ids[i:i+self.batch_size]:
+                batch.add(service.users().messages().get(userId=self.user_id, id=message_id,
+                                                         format='metadata', fields='snippet'),
+                          request_id=message_id)
+            batch.execute()
+
+        return snippets
+
+    def extract_leagues(self, snippets):
+        ''' pull league names out of notification text '''
+        message_leagues = []
+        for snippet in snippets:
+            s = self.league_pattern.search(snippet)
+            if s:
+                message_leagues.append(s.group(1).strip())
+
+        return message_leagues
+
     def mark_as_read(self):
         self.recorder.set_time('check_mail')
\ No newline at end of file
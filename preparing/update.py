@@ -1,6 +1,13 @@
 ''' Getting data from and pushing data to MusicLeague and updating playlists  '''
 
-from common.words import Texter
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+from datetime import date
+import time
+
+from pandas import DataFrame
+
+from common.words import Texter, NameMatcher
 from common.calling import Recorder
 from display.storage import GClouder
 from preparing.extract import Stripper, Scraper
@@ -13,8 +20,13 @@ class Updater:
         self.stripper = Stripper()
         self.texter = Texter()
         self.gclouder = GClouder()
+        self.recorder = Recorder(database)
 
-    def update_musicleague(self, league_ids=None):
+        # seconds spent in each stage of ingestion
+        self.stages = {}
+        self.stages_lock = Lock()
+
+    def update_musicleague(self, league_ids=None, workers=1, stream=False):
         print('Updating database')
 
         # get information from home page
@@ -29,41 +41,153 @@ class Updater:
             league_titles = leagues_df['league_name']
             league_ids = leagues_df['league_id']
 
-        # store home page information
-        for league_title, league_id in zip(league_titles, league_ids):
-            print(f'Investigating {league_title}...')
-            
-            # get information from league page
-            self.update_league(league_id) 
-            self.update_creators(league_id)
+        if workers > 1:
+            self.update_pipeline(league_titles, league_ids, workers=workers, stream=stream)
 
-            # remove stored graphs
-            self.gclouder.clear_items(league_id)
+        else:
+            # store home page information
+            for league_title, league_id in zip(league_titles, league_ids):
+                print(f'Investigating {league_title}...')
+                
+                # get information from league page
+                fingerprint = self.update_league(league_id, stream=stream)
+                if fingerprint:
+                    self.timed('creators', self.update_creators, league_id)
+
+                    # remove stored graphs
+                    self.finish_league(league_id, fingerprint)
 
         # update all competitions
         self.update_competitions()
 
-    def update_league(self, league_id):
+        self.print_stages()
+
+    def update_pipeline(self, league_titles, league_ids, workers=4, stream=False):
+        ''' download every league at once and store each as its download finishes '''
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            downloads = [executor.submit(self.timed, 'download', self.scraper.get_data_zip, league_id, stream=stream) \
+                         for league_id in league_ids]
+
+            # parse and store in league order so each league's writes stay in sequence
+            finishes = {}
+            for league_title, league_id, download in zip(league_titles, league_ids, downloads):
+                print(f'Investigating {league_title}...')
+
+                fingerprint = self.ingest_league(league_id, download.result(), stream=stream)
+                if fingerprint:
+                    self.timed('creators', self.update_creators, league_id)
+
+                    # remove stored graphs in the background once the data has changed
+                    finishes[league_title] = executor.submit(self.finish_league, league_id, fingerprint)
+
+            for league_title, finish in finishes.items():
+                if finish.exception():
+                    print(f'\t...clearing {league_title} failed due to {finish.exception()}, it will be stored again next time')
+
+    def timed(self, stage, function, *args, **kwargs):
+        start = time.perf_counter()
+        result = function(*args, **kwargs)
+        elapsed = time.perf_counter() - start
+
+        with self.stages_lock:
+            self.stages[stage] = self.stages.get(stage, 0) + elapsed
+
+        return result
+
+    def print_stages(self):
+        ''' show how long each part of ingestion took across leagues '''
+        if len(self.stages):
+            stages_df = DataFrame(self.stages.items(), columns=['stage', 'seconds'])
+            print(f'Ingestion summary\n{stages_df.round(2)}')
+
+    def update_league(self, league_id, stream=False):
         # get the zip file from each league
-        data_zip = self.scraper.get_data_zip(league_id)
-        results = self.stripper.unzip_results(data_zip)
+        data_zip = self.timed('download', self.scraper.get_data_zip, league_id, stream=stream)
+        fingerprint = self.ingest_league(league_id, data_zip, stream=stream)
+
+        return fingerprint
+
+    def finish_league(self, league_id, fingerprint):
+        ''' remove stored graphs, then remember the export so it isn't stored again '''
+        self.timed('clear', self.gclouder.clear_items, league_id)
+
+        # only now is the league completely up to date
+        self.recorder.set_fingerprint(league_id, fingerprint['sheets'], fingerprint['watermark'])
+
+    def ingest_league(self, league_id, data_zip, stream=False):
+        ''' store a league export if it changed since last time, and return the fingerprint to record once finished '''
+        if data_zip is None:
+            return None
+
+        try:
+            # skip leagues whose export is the same as last time
+            sheets = self.timed('fingerprint', self.stripper.fingerprint_zip, data_zip)
+            fingerprint = self.recorder.get_fingerprint(league_id)
+            if fingerprint and (fingerprint['sheets'] == sheets):
+                print('\t...no changes')
+                return None
+
+            if stream:
+                # votes are read as they are stored, so parsing them counts toward storing
+                results = self.timed('parse', self.stripper.stream_results, data_zip)
+            else:
+                results = self.timed('parse', self.stripper.unzip_results, data_zip)
+
+            # only songs and votes since the last stored date need writing
+            watermark = fingerprint['watermark'] if fingerprint else None
+            if results is not None:
+                watermark = self.timed('store', self.store_league, league_id, results, watermark=watermark)
+
+        finally:
+            # votes may not have been read to the end if storing failed
+            self.stripper.close_zip(data_zip)
+
+        return {'sheets': sheets, 'watermark': watermark}
+
+    def store_league(self, league_id, results, watermark=None):
+        ''' store an export and return the latest date in it '''
+        players, rounds, songs, votes, tracks = results
 
-        if results is not None:
+        # update song_ids
+        song_ids = self.database.get_song_ids(league_id, songs)
 
-            players, rounds, songs, votes, tracks = results
+        songs = self.renumber_songs(songs, song_ids)
+        latest = self.get_latest(songs)
 
-            # update song_ids
-            song_ids = self.database.get_song_ids(league_id, songs)
+        # store data in order
+        self.database.store_players(players, league_id=league_id)
+        self.database.store_rounds(rounds, league_id)
+        self.database.store_tracks(self.stripper.get_tracks(self.since(songs, watermark)))
+        self.database.store_songs(self.since(songs, watermark), league_id)
 
-            songs = songs.merge(song_ids, on='song_id').drop(columns=['song_id']).rename(columns={'new_song_id': 'song_id'})
-            votes = votes.merge(song_ids, on='song_id').drop(columns=['song_id']).rename(columns={'new_song_id': 'song_id'})
+        if isinstance(votes, DataFrame):
+            votes = [votes]
 
-            # store data in order
-            self.database.store_players(players, league_id=league_id)
-            self.database.store_rounds(rounds, league_id)
-            self.database.store_tracks(tracks)
-            self.database.store_songs(songs, league_id)
-            self.database.store_votes(votes, league_id)
+        # store batches of votes as they are read
+        for votes_batch in votes:
+            votes_batch = self.renumber_songs(votes_batch, song_ids)
+            latest = max(filter(None, [latest, self.get_latest(votes_batch)]), default=None)
+            self.database.store_votes(self.since(votes_batch, watermark), league_id)
+
+        return latest
+
+    def renumber_songs(self, df, song_ids):
+        df = df.merge(song_ids, on='song_id').drop(columns=['song_id']).rename(columns={'new_song_id': 'song_id'})
+
+        return df
+
+    def get_latest(self, df):
+        latest = df['created_date'].dropna().max() if len(df) else None
+        latest = latest.isoformat() if latest else None
+
+        return latest
+
+    def since(self, df, watermark=None):
+        # keep the watermark day itself since dates don't say what time of day was stored
+        if watermark:
+            df = df[df['created_date'] >= date.fromisoformat(watermark)]
+
+        return df
 
     def update_creators(self, league_id):
         rounds_df = self.database.get_uncreated_rounds(league_id)
@@ -74,36 +198,36 @@ class Updater:
             players = self.database.get_player_names().merge(player_ids, how='right', on='player_id')[['player_id', 'player_name']]
 
             league_creator_id = self.database.get_league_creator(league_id)
+            # index the player names once for every round in the league
+            matcher = NameMatcher(players['player_name'].values)
         
             rounds_df[['creator_id', 'capture']] = rounds_df.apply(lambda x: \
-                                             self.find_creator(x['description'], players, league_creator_id),
+                                             self.find_creator(x['description'], players, league_creator_id, matcher),
                                                                 axis=1, result_type='expand')
 
             self.database.store_rounds(rounds_df, league_id)
 
-    def find_creator(self, description, players, league_creator_id):
+    def find_creator(self, description, players, league_creator_id, matcher=None):
         creator = None
         captured = None
               
         if description:
             # look for creator name in description
-            player_names = players['player_name'].values
+            if matcher is None:
+                matcher = NameMatcher(players['player_name'].values)
             # first look for item in Created By, Submitted By, etc
             _, captured = self.texter.remove_parenthetical(description, self.stripper.get_creator_phrases(),
                                                             position='start', parentheses='all_end')
             if captured:
-                creator = self.texter.find_closest_match(captured, player_names)
+                creator = matcher.find_closest_match(captured)
 
             # then look to see if a player name is in the description
             if not creator:
-                for player_name in player_names:
-                    if player_name in description:
-                        creator = player_name
-                        break
+                creator = matcher.find_in_text(description)
 
             if creator:
                 # find the closest match if a creator name was found
-                creator = self.texter.find_closest_match(creator, player_names)
+                creator = matcher.find_closest_match(creator)
 
         # match creator name to ID and default to league creator
         query = players.query('player_name == @creator')
@@ -123,7 +247,11 @@ class Extender:
         self.stripper = Stripper()
         self.recorder = Recorder(database)
 
-    def update_deadlines(self, league_id, round_id, status, days=0, hours=0):
+        # seconds spent waiting on each league
+        self.timings = {}
+        self.timings_lock = Lock()
+
+    def update_deadlines(self, league_id, round_id, status, days=0, hours=0, dry_run=False):
         ''' move out deadlines for a round '''
         dl_types = self.stripper.extract_deadline_types(status)
         round_jason = self.scraper.get_due_dates(league_id, round_id)
@@ -135,7 +263,10 @@ class Extender:
                 if self.stripper.has_occured(due_date):
                     round_jason[f'{dl}Due'] = self.stripper.push_date(due_date, days, hours)
                     
-            self.scraper.post_due_dates(league_id, round_id, round_jason)
+            if dry_run:
+                print(f'\t...would extend {league_id}/{round_id} to ' + ', '.join(f'{dl} {round_jason[f"{dl}Due"]}' for dl in dl_types))
+            else:
+                self.scraper.post_due_dates(league_id, round_id, round_jason)
             
     def check_outstanding(self, league_id, round_id, status, submit_date, vote_date,
                           inactive_players=[], hours_left=0):
@@ -146,18 +277,24 @@ class Extender:
             period, due_date = extracted
 
             standing_jason = self.scraper.get_outstanding(league_id, round_id, period)
-            outstanding_players = self.stripper.extract_outstanding_players(standing_jason, status, inactive_players)
-            
-            if len(outstanding_players):
-                outstanding = self.stripper.is_outstanding(due_date, hours_left)
-            else:
-                outstanding = False
+            outstanding = self.decide_outstanding(standing_jason, status, due_date, inactive_players, hours_left)
 
         else:
             outstanding = None
 
         return outstanding
 
+    def decide_outstanding(self, standing_jason, status, due_date, inactive_players=[], hours_left=0):
+        ''' a round is outstanding if active players haven't played and the deadline is close '''
+        outstanding_players = self.stripper.extract_outstanding_players(standing_jason, status, inactive_players)
+        
+        if len(outstanding_players):
+            outstanding = self.stripper.is_outstanding(due_date, hours_left)
+        else:
+            outstanding = False
+
+        return outstanding
+
     def check_open_rounds(self, league_id, inactive_players, hours_left):
         ''' find which rounds are current '''
         round_jason = self.scraper.get_round_details(league_id)
@@ -172,33 +309,98 @@ class Extender:
                                                     inactive_players,
                                                     hours_left=hours_left),
                    axis=1)
+            
+        return self.decide_open_rounds(open_rounds)
 
+    def decide_open_rounds(self, open_rounds):
+        ''' if any round is outstanding, every unfinished round gets pushed out together '''
         if open_rounds['outstanding'].sum():
             open_rounds.loc[:, 'outstanding'] = open_rounds.apply(lambda x: not self.stripper.is_complete(x['status']),
                                                                   axis=1)
             
         return open_rounds
 
-    def extend_deadlines(self, league_id, days, hours, hours_left, inactive_players=[]):
-        open_rounds = self.check_open_rounds(league_id, inactive_players=inactive_players, hours_left=hours_left)
+    def extend_deadlines(self, league_id, days, hours, hours_left, inactive_players=[], open_rounds=None, dry_run=False):
+        if open_rounds is None:
+            open_rounds = self.check_open_rounds(league_id, inactive_players=inactive_players, hours_left=hours_left)
         open_rounds.sort_values(by='date', ascending=False, inplace=True)
 
         for i in open_rounds[open_rounds['outstanding'].fillna(False)].index:
             self.update_deadlines(league_id, open_rounds['round_id'][i], open_rounds['status'][i],
-                                  days=days, hours=hours)
+                                  days=days, hours=hours, dry_run=dry_run)
 
-    def extend_all_deadlines(self, days=1, hours=0, hours_left=24):
+    def extend_all_deadlines(self, days=1, hours=0, hours_left=24, workers=1, dry_run=False):
         league_ids = self.database.get_extendable_leagues()
 
         print('Extending deadlines...')
-        for league_id in league_ids:
-            # extend cascading deadlines when the open round has a deadline coming up and outstanding voters
-            inactive_players = self.database.get_inactive_players(league_id)
-            self.extend_deadlines(league_id, days, hours, hours_left, inactive_players)
+        if workers > 1:
+            self.extend_parallel(league_ids, days, hours, hours_left, workers=workers, dry_run=dry_run)
 
-        self.recorder.set_time('extension') # mark that extensions have been checked
+        else:
+            for league_id in league_ids:
+                # extend cascading deadlines when the open round has a deadline coming up and outstanding voters
+                inactive_players = self.database.get_inactive_players(league_id)
+                self.extend_deadlines(league_id, days, hours, hours_left, inactive_players, dry_run=dry_run)
+
+        if not dry_run:
+            self.recorder.set_time('extension') # mark that extensions have been checked
         print('\t...complete!')
 
+    def extend_parallel(self, league_ids, days, hours, hours_left, workers=4, dry_run=False):
+        ''' fetch every league's rounds and standings at once, then only call back for rounds to extend '''
+        self.timings = {league_id: 0 for league_id in league_ids}
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            inactives = {league_id: executor.submit(self.database.get_inactive_players, league_id) for league_id in league_ids}
+            details = {league_id: executor.submit(self.timed, league_id, self.scraper.get_round_details, league_id) \
+                       for league_id in league_ids}
+
+            # ask for standings of every open round
+            leagues_rounds = {}
+            standings = {}
+            for league_id in league_ids:
+                open_rounds = self.stripper.extract_open_rounds(details[league_id].result())
+                open_rounds['period'] = None
+                open_rounds['due_date'] = None
+                for i in open_rounds.index:
+                    extracted = self.stripper.extract_status(open_rounds['status'][i], open_rounds['submit_date'][i],
+                                                             open_rounds['vote_date'][i])
+                    if extracted:
+                        open_rounds.loc[i, ['period', 'due_date']] = extracted
+                        standings[(league_id, i)] = executor.submit(self.timed, league_id, self.scraper.get_outstanding,
+                                                                    league_id, open_rounds['round_id'][i], extracted[0])
+                leagues_rounds[league_id] = open_rounds
+
+            # decide locally which rounds need pushing out
+            for league_id in league_ids:
+                open_rounds = leagues_rounds[league_id]
+                inactive_players = inactives[league_id].result()
+                open_rounds['outstanding'] = [self.decide_outstanding(standings[(league_id, i)].result(),
+                                                                      open_rounds['status'][i], open_rounds['due_date'][i],
+                                                                      inactive_players, hours_left) \
+                                              if (league_id, i) in standings else None for i in open_rounds.index]
+                leagues_rounds[league_id] = self.decide_open_rounds(open_rounds)
+
+            # rounds within a league are pushed in order, leagues side by side
+            extensions = [executor.submit(self.timed, league_id, self.extend_deadlines, league_id, days, hours, hours_left,
+                                          open_rounds=leagues_rounds[league_id], dry_run=dry_run) \
+                          for league_id in league_ids if leagues_rounds[league_id]['outstanding'].fillna(False).any()]
+            for extension in extensions:
+                extension.result()
+
+        timings_df = DataFrame([[league_id, leagues_rounds[league_id]['outstanding'].fillna(False).sum(), self.timings[league_id]] \
+                                for league_id in league_ids], columns=['league_id', 'extended', 'seconds'])
+        print(f'Deadline summary\n{timings_df.round(2)}')
+
+    def timed(self, league_id, function, *args, **kwargs):
+        ''' add time spent waiting to a league's total '''
+        start = time.perf_counter()
+        result = function(*args, **kwargs)
+        with self.timings_lock:
+            self.timings[league_id] = self.timings.get(league_id, 0) + time.perf_counter() - start
+
+        return result
+
     def reopen_round(self, league_id, round_id, hours=24):
         immutable_statuses = ['NOT STARTED', 'ACCEPTING SUBMISSIONS']
         mutable_statuses = ['ACCEPTING VOTES', 'COMPLETE']
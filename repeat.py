@@ -8,7 +8,7 @@ def update_deadlines():
     database = Database()
     extender = Extender(database)
 
-    extender.extend_all_deadlines(days=1, hours_left=24)
+    extender.extend_all_deadlines(days=1, hours_left=24, workers=8)
 
 def main():
     update_deadlines()
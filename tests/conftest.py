@@ -0,0 +1,55 @@
+''' Shared fixtures for tests '''
+
+import sys
+from os import path
+from threading import Thread
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import pytest
+
+# run from anywhere and still import the app modules
+sys.path.insert(0, path.dirname(path.dirname(path.abspath(__file__))))
+
+class StubHandler(BaseHTTPRequestHandler):
+    ''' answers requests with whatever the test routes say '''
+    routes = {}
+    calls = []
+
+    def respond(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b''
+        self.calls.append((self.command, self.path, self.headers, body))
+
+        route = self.path.split('?')[0]
+        status, headers, content = self.routes[route](self, body) if route in self.routes else (404, {}, b'')
+
+        self.send_response(status)
+        for header, value in headers.items():
+            self.send_header(header, value)
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    do_GET = respond
+    do_POST = respond
+    do_PUT = respond
+
+    def log_message(self, format, *args):
+        pass
+
+@pytest.fixture
+def stub_server():
+    ''' local HTTP server whose routes map a path to a function returning (status, headers, content) '''
+    handler = type('Handler', (StubHandler,), {'routes': {}, 'calls': []})
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    thread = Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    server.url = f'http://127.0.0.1:{server.server_port}'
+    server.routes = handler.routes
+    server.calls = handler.calls
+
+    yield server
+
+    server.shutdown()
+    server.server_close()
@@ -0,0 +1,87 @@
+''' Placing every league '''
+
+from itertools import permutations
+
+import pytest
+from numpy import hypot, nan
+from numpy.random import default_rng
+from pandas import DataFrame
+
+from crunching.analyze import Analyzer
+
+def make_league(n_players, seed=0):
+    ''' members with no placement yet and the distances between them '''
+    rng = default_rng(seed)
+    points = rng.normal(size=(n_players, 2))
+    player_ids = [f'player-{p}' for p in range(n_players)]
+
+    members_df = DataFrame({'player_id': player_ids, 'x': nan, 'y': nan})
+    distances_df = DataFrame([(player_ids[i], player_ids[j], hypot(*(points[i] - points[j]))) \
+                              for i, j in permutations(range(n_players), 2)],
+                             columns=['player_id', 'opponent_id', 'distance'])
+    distances_df['plot_distance'] = distances_df['distance']
+
+    return members_df, distances_df
+
+class StubDatabase:
+    ''' leagues to place, keeping whatever is stored '''
+    def __init__(self, leagues, fail_storing=False):
+        self.leagues = leagues
+        self.fail_storing = fail_storing
+        self.optimizations = {}
+        self.members = {}
+
+    def get_league_ids(self):
+        return list(self.leagues)
+
+    def check_data(self, league_id):
+        return True
+
+    def get_league_name(self, league_id):
+        return league_id.title()
+
+    def get_optimized(self, league_id):
+        return league_id in self.optimizations
+
+    def get_members(self, league_id):
+        return self.leagues[league_id][0]
+
+    def get_distances(self, league_id):
+        return self.leagues[league_id][1]
+
+    def get_rounds(self, league_id):
+        return DataFrame({'round_id': [f'{league_id}-round-{r}' for r in range(3)]})
+
+    def store_members(self, members_df, league_id):
+        if self.fail_storing:
+            raise ConnectionError('database went away')
+        self.members[league_id] = members_df
+
+    def store_optimizations(self, league_id, round_ids=None, optimized=None):
+        self.optimizations[league_id] = {'round_ids': round_ids, 'optimized': optimized}
+
+@pytest.mark.parametrize('workers', [1, 2])
+def test_placements_are_recorded(workers):
+    database = StubDatabase({'league-a': make_league(5), 'league-b': make_league(6, seed=1)})
+    Analyzer(database).place_all(workers=workers)
+
+    assert set(database.optimizations) == {'league-a', 'league-b'}
+    assert database.optimizations['league-a']['round_ids'] == ['league-a-round-0', 'league-a-round-1', 'league-a-round-2']
+
+    # so the next run doesn't solve them again
+    analyzer = Analyzer(database)
+    analyzer.place_all(workers=workers)
+    assert analyzer.solves == []
+
+def test_solver_failures_skip_only_that_league():
+    broken = make_league(5)[0], DataFrame({'player_id': ['player-0']})
+    database = StubDatabase({'league-a': make_league(5), 'league-b': broken})
+    Analyzer(database).place_all(workers=2)
+
+    assert set(database.optimizations) == {'league-a'}
+
+def test_storing_failures_are_not_hidden():
+    database = StubDatabase({'league-a': make_league(5)}, fail_storing=True)
+
+    with pytest.raises(ConnectionError):
+        Analyzer(database).place_all(workers=2)
@@ -0,0 +1,128 @@
+''' Looking up music on Spotify '''
+
+import json
+from urllib.parse import urlparse, parse_qs
+
+import pytest
+from spotipy import Spotify
+from pandas import DataFrame
+
+from display.streaming import Streamable
+from preparing.audio import Spotter
+
+UNKNOWN = 'missing'
+
+def reply_by_id(kind, make):
+    ''' answer a batch lookup in the order asked, with null for ids Spotify doesn't know '''
+    def reply(handler, body):
+        ids = parse_qs(urlparse(handler.path).query)['ids'][0].split(',')
+        jason = {kind: [None if i.startswith(UNKNOWN) else make(i) for i in ids]}
+        return 200, {'Content-Type': 'application/json'}, json.dumps(jason).encode()
+
+    return reply
+
+def make_track(i):
+    return {'uri': f'spotify:track:{i}', 'name': f'Track {i}', 'explicit': False, 'popularity': len(i),
+            'artists': [{'uri': f'spotify:artist:{i}'}], 'album': {'uri': f'spotify:album:{i}'}}
+
+def make_features(i):
+    features = {key: len(i) for key in Spotter.audio_features}
+    features['duration_ms'] = 180000
+
+    return features
+
+def make_artist(i):
+    return {'uri': f'spotify:artist:{i}', 'name': f'Artist {i}', 'genres': ['indie'], 'popularity': len(i),
+            'followers': {'total': 100}, 'images': [{'url': f'https://i.scdn.co/image/{i}'}]}
+
+def make_album(i):
+    return {'uri': f'spotify:album:{i}', 'name': f'Album {i}', 'genres': [], 'popularity': len(i),
+            'release_date': '2020-05', 'release_date_precision': 'month',
+            'images': [{'url': f'https://i.scdn.co/image/{i}'}]}
+
+class StubDatabase:
+    ''' hands out rows to update and keeps whatever is stored '''
+    def __init__(self, **updates):
+        self.updates = updates
+        self.stored = {}
+
+    def get_tracks_update_sp(self):
+        return self.updates['tracks']
+
+    def get_artists_update_sp(self):
+        return self.updates['artists']
+
+    def get_albums_update_sp(self):
+        return self.updates['albums']
+
+    def store_tracks(self, df):
+        self.stored['tracks'] = df
+
+    def store_artists(self, df):
+        self.stored['artists'] = df
+
+    def store_albums(self, df):
+        self.stored['albums'] = df
+
+@pytest.fixture
+def spotter(stub_server):
+    stub_server.routes['/v1/tracks/'] = reply_by_id('tracks', make_track)
+    stub_server.routes['/v1/audio-features/'] = reply_by_id('audio_features', make_features)
+    stub_server.routes['/v1/artists/'] = reply_by_id('artists', make_artist)
+    stub_server.routes['/v1/albums/'] = reply_by_id('albums', make_album)
+
+    # skip the Dropbox and Google connections, which lookups don't use
+    spotter = Spotter.__new__(Spotter)
+    Streamable.__init__(spotter)
+    spotter.sp = Spotify(auth='token', retries=0, status_retries=0)
+    spotter.sp.prefix = f'{stub_server.url}/v1/'
+
+    return spotter
+
+def get_batches(stub_server, endpoint):
+    ''' how many ids went out in each call to an endpoint '''
+    return [len(parse_qs(urlparse(path).query)['ids'][0].split(',')) \
+            for _, path, _, _ in stub_server.calls if urlparse(path).path == f'/v1/{endpoint}/']
+
+def make_rows(kind, n, unknown=0, repeats=0):
+    ids = [f'{kind[0]}{n_i:03d}' for n_i in range(n)] + [f'{UNKNOWN}{n_i}' for n_i in range(unknown)]
+
+    return DataFrame({'uri': [f'spotify:{kind}:{i}' for i in ids + ids[:repeats]]})
+
+def test_tracks_are_looked_up_in_batches(stub_server, spotter):
+    tracks_db = make_rows('track', 118, unknown=2)
+    spotter.database = StubDatabase(tracks=tracks_db)
+    spotter.update_db_tracks()
+
+    assert get_batches(stub_server, 'tracks') == [50, 50, 20]
+    assert get_batches(stub_server, 'audio-features') == [100, 20]
+
+    stored = spotter.database.stored['tracks']
+    assert len(stored) == len(tracks_db)
+
+    # every row got the details of its own uri
+    known = ~stored['uri'].str.contains(UNKNOWN)
+    assert (stored.loc[known, 'name'] == 'Track ' + stored.loc[known, 'uri'].str.split(':').str[-1]).all()
+    assert (stored.loc[known, 'album_uri'] == stored.loc[known, 'uri'].str.replace('track', 'album')).all()
+    assert (stored.loc[known, 'duration'] == 3).all()
+
+    # and rows Spotify doesn't know are left as they were
+    assert stored.loc[~known, 'name'].isna().all()
+
+def test_artists_and_albums_are_looked_up_in_batches(stub_server, spotter):
+    # the same uri can come up twice but is only asked for once
+    spotter.database = StubDatabase(artists=make_rows('artist', 60, repeats=3), albums=make_rows('album', 25))
+    spotter.update_db_artists()
+    spotter.update_db_albums()
+
+    assert get_batches(stub_server, 'artists') == [50, 10]
+    assert get_batches(stub_server, 'albums') == [20, 5]
+
+    artists = spotter.database.stored['artists']
+    assert len(artists) == 63
+    assert (artists['name'] == 'Artist ' + artists['uri'].str.split(':').str[-1]).all()
+    assert (artists['followers'] == 100).all()
+
+    albums = spotter.database.stored['albums']
+    assert (albums['name'] == 'Album ' + albums['uri'].str.split(':').str[-1]).all()
+    assert (albums['release_date'].dt.month == 5).all()
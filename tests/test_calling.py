@@ -0,0 +1,106 @@
+''' Calling APIs through the response cache '''
+
+import json
+
+import pytest
+from requests import Response
+
+import preparing.audio
+from common.calling import Caller, Cacher
+from preparing.audio import FMer
+
+TRACK = {'track': {'playcount': '10', 'listeners': '5', 'toptags': {'tag': [{'name': 'indie'}]}}}
+
+@pytest.fixture
+def cacher(tmp_path, monkeypatch):
+    cacher = Cacher(location=str(tmp_path / 'responses.sqlite'))
+    monkeypatch.setattr(Caller, 'cacher', cacher)
+
+    return cacher
+
+@pytest.fixture
+def fmer(stub_server, monkeypatch):
+    monkeypatch.setattr(preparing.audio, 'LASTFM_URL', stub_server.url)
+    monkeypatch.setattr(FMer, 'get_backoff', lambda self, attempt, retry_after=None: 0)
+
+    return FMer()
+
+def reply_in_turn(*bodies):
+    ''' answer each call with the next body, repeating the last '''
+    replies = list(bodies)
+
+    def reply(handler, body):
+        jason = replies.pop(0) if len(replies) > 1 else replies[0]
+        return 200, {'Content-Type': 'application/json'}, json.dumps(jason).encode()
+
+    return reply
+
+def test_error_in_body_is_not_cached(stub_server, cacher, fmer):
+    # LastFM says it is busy with a 200, then answers
+    stub_server.routes['/2.0/'] = reply_in_turn({'error': 29, 'message': 'Rate limit exceeded'}, TRACK)
+
+    _, jason = fmer.call_api('Artist', 'Title')
+    assert jason == TRACK
+    assert len(stub_server.calls) == 2
+
+    # the answer is cached, not the error
+    _, jason = fmer.call_api('Artist', 'Title')
+    assert jason == TRACK
+    assert len(stub_server.calls) == 2
+    assert cacher.counts['hit'] == 1
+
+def test_retry_skips_cache(stub_server, cacher, fmer):
+    stub_server.routes['/2.0/'] = reply_in_turn(TRACK)
+
+    # an error already pinned in the cache, as older runs could leave behind
+    response = Response()
+    response.status_code = 200
+    response.headers['Content-Type'] = 'application/json'
+    response._content = json.dumps({'error': 29, 'message': 'Rate limit exceeded'}).encode()
+    url = (f'{stub_server.url}/2.0/?method=track.getinfo&api_key={fmer.api_key}&format=json'
+           f'&artist=Artist&track=Title')
+    cacher.put(cacher.get_key('get', url), response)
+
+    elements = fmer.get_track_info('Artist', 'Title')
+    assert elements['scrobbles'] == 10
+    assert len(stub_server.calls) == 1
+
+def test_persistent_error_is_never_cached(stub_server, cacher, fmer):
+    stub_server.routes['/2.0/'] = reply_in_turn({'error': 11, 'message': 'Service offline'})
+
+    _, jason = fmer.call_api('Artist', 'Title')
+    assert jason['error'] == 11
+    assert len(stub_server.calls) == fmer.fm_retries + 1
+    assert cacher.counts['stored'] == 0
+
+    # the next run asks again instead of reading the error back
+    fmer.call_api('Artist', 'Title')
+    assert len(stub_server.calls) == 2 * (fmer.fm_retries + 1)
+
+def test_failed_calls_retry_only_under_the_limiter(stub_server, cacher, fmer):
+    stub_server.routes['/2.0/'] = lambda handler, body: (503, {}, b'')
+
+    # no HTTP retries hidden inside each of FMer's own tries
+    _, jason = fmer.call_api('Artist', 'Title')
+    assert jason is None
+    assert len(stub_server.calls) == fmer.fm_retries + 1
+
+def test_lastfm_retries_leave_http_retries_alone():
+    assert FMer.fm_retries == 3
+    assert FMer.retries is Caller.retries
+
+def test_cache_version_changes_only_with_stored_responses(stub_server, cacher, fmer, tmp_path):
+    stub_server.routes['/2.0/'] = reply_in_turn(TRACK)
+    fmer.call_api('Artist', 'Title')
+    cacher.write_version()
+    stored = (tmp_path / 'responses.version').read_text()
+
+    # reading the cache back doesn't make it worth saving again
+    fmer.call_api('Artist', 'Title')
+    assert cacher.counts['hit'] == 1
+    cacher.write_version()
+    assert (tmp_path / 'responses.version').read_text() == stored
+
+    fmer.call_api('Other Artist', 'Other Title')
+    cacher.write_version()
+    assert (tmp_path / 'responses.version').read_text() != stored
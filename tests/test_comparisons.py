@@ -0,0 +1,185 @@
+''' Placing players '''
+
+from itertools import permutations
+
+import tracemalloc
+from time import perf_counter
+from types import SimpleNamespace
+
+import pytest
+from numpy import hypot, zeros, isnan
+from numpy.random import default_rng
+from scipy.optimize import check_grad
+from pandas import DataFrame
+
+from crunching.comparisons import Members, Pulse, Patternizer
+
+def make_pulse(n_players, seed=0):
+    ''' distances between players scattered on a plane, with some noise '''
+    rng = default_rng(seed)
+    points = rng.normal(size=(n_players, 2))
+    player_ids = [f'player-{p}' for p in range(n_players)]
+
+    distances = [(player_ids[i], player_ids[j], hypot(*(points[i] - points[j])) * rng.uniform(0.8, 1.2)) \
+                 for i, j in permutations(range(n_players), 2)]
+    pulse = Pulse(DataFrame(distances, columns=['player_id', 'opponent_id', 'distance']))
+    pulse.df['plot_distance'] = pulse.df['distance']
+
+    return pulse, player_ids
+
+def make_patternizer(n_players, n_rounds, seed=0):
+    ''' a league where most players submit and vote each round '''
+    rng = default_rng(seed)
+    player_ids = [f'player-{p}' for p in range(n_players)]
+
+    songs = []
+    votes = []
+    for r in range(n_rounds):
+        active = [p for p in player_ids if rng.random() < 0.85]
+        round_songs = [(len(songs) + i, f'round-{r}', p) for i, p in enumerate(active)]
+        songs += round_songs
+
+        for voter in active:
+            if rng.random() < 0.9:
+                options = [song_id for song_id, _, submitter_id in round_songs if submitter_id != voter]
+                for song_id in rng.choice(options, size=min(3, len(options)), replace=False):
+                    votes.append((int(song_id), f'round-{r}', voter, int(rng.integers(1, 4))))
+
+    songs = DataFrame(songs, columns=['song_id', 'round_id', 'submitter_id'])
+    votes = DataFrame(votes, columns=['song_id', 'round_id', 'player_id', 'vote'])
+
+    return Patternizer(SimpleNamespace(df=songs), SimpleNamespace(df=votes), player_ids)
+
+def get_stress(members, pulse):
+    distances = DataFrame(members.player_combinations, columns=['player_id', 'opponent_id'])\
+        .merge(pulse.df, on=['player_id', 'opponent_id'], how='left')['plot_distance']
+
+    return members.distdiff(members.melt_xy(members.df), distances, distances.notna())
+
+def test_seed_places_new_players_apart():
+    pulse, player_ids = make_pulse(8)
+    members = Members(player_ids)
+    members.seed_xy(pulse)
+
+    assert members.df[['x', 'y']].notna().all().all()
+    assert len(members.df[['x', 'y']].round(6).drop_duplicates()) == len(player_ids)
+
+def test_coincident_players_are_pushed_apart():
+    pulse, player_ids = make_pulse(6)
+    members = Members(player_ids)
+    D, N, I, J = members.vectorize_distances(pulse.df['distance'][:len(members.player_combinations)],
+                                             [True] * len(members.player_combinations))
+
+    _, gradient = members.stress(zeros(2 * (len(player_ids) - 1)), D, N, I, J)
+    assert abs(gradient).sum() > 0
+
+def test_stress_gradient_is_analytic():
+    pulse, player_ids = make_pulse(6)
+    members = Members(player_ids)
+    D, N, I, J = members.vectorize_distances(pulse.df['distance'][:len(members.player_combinations)],
+                                             [True] * len(members.player_combinations))
+
+    xy = default_rng(1).normal(size=2 * (len(player_ids) - 1))
+    error = check_grad(lambda v: members.stress(v, D, N, I, J)[0], lambda v: members.stress(v, D, N, I, J)[1], xy)
+    assert error < 1e-5
+
+@pytest.mark.parametrize('n_players', [5, 10, 20])
+def test_engines_reach_same_stress_on_fresh_league(n_players):
+    pulse, player_ids = make_pulse(n_players)
+
+    stresses = {}
+    for engine in ['legacy', 'vectorized']:
+        members = Members(player_ids)
+        members.update_coordinates(pulse, engine=engine)
+
+        # nobody is left stacked at the origin
+        assert (members.df[['x', 'y']].abs().sum(axis=1) > 0).sum() == n_players - 1
+        stresses[engine] = get_stress(members, pulse)
+
+    assert stresses['vectorized'] == pytest.approx(stresses['legacy'], rel=0.01)
+
+def time_placement(pulse, player_ids, engine):
+    members = Members(player_ids)
+    start = perf_counter()
+    members.update_coordinates(pulse, engine=engine)
+
+    return perf_counter() - start, get_stress(members, pulse)
+
+@pytest.mark.parametrize('n_players', [10, 50])
+def test_vectorized_engine_is_faster(n_players):
+    # measured 0.03s vs 0.2s at 10 players and 0.03s vs 5.9s at 50
+    pulse, player_ids = make_pulse(n_players)
+    vectorized_time, vectorized_stress = time_placement(pulse, player_ids, 'vectorized')
+    legacy_time, legacy_stress = time_placement(pulse, player_ids, 'legacy')
+
+    assert vectorized_time < legacy_time
+    assert vectorized_stress == pytest.approx(legacy_stress, rel=0.01)
+
+def test_vectorized_engine_places_a_large_league():
+    # measured 0.1s, where the legacy engine took 285s to reach the same stress
+    pulse, player_ids = make_pulse(200)
+    vectorized_time, _ = time_placement(pulse, player_ids, 'vectorized')
+
+    assert vectorized_time < 10
+
+def place_incrementally(pulse, player_ids, xy_, tolerance=0.1):
+    members = Members(player_ids)
+    members.update_coordinates(pulse, xy_=xy_, incremental=True, tolerance=tolerance)
+
+    return members
+
+def test_incremental_keeps_a_good_layout():
+    pulse, player_ids = make_pulse(5)
+    members = Members(player_ids)
+    members.update_coordinates(pulse)
+    xy_ = members.get_members()
+
+    # one player's distances move a little
+    moved = pulse.df['player_id'].eq(player_ids[-1]) | pulse.df['opponent_id'].eq(player_ids[-1])
+    pulse.df.loc[moved, 'plot_distance'] = pulse.df.loc[moved, 'plot_distance'] * 1.3
+
+    members = place_incrementally(pulse, player_ids, xy_)
+    assert members.coordinates['mode'] == 'incremental'
+    assert members.coordinates['success']
+
+def test_incremental_falls_back_when_layout_drifted():
+    pulse, player_ids = make_pulse(5)
+
+    # a stored layout that doesn't fit, where no single player looks like it moved enough to free
+    xy_ = DataFrame({'player_id': player_ids, 'x': default_rng(2).normal(size=5), 'y': default_rng(3).normal(size=5)})
+
+    drifted = place_incrementally(pulse, player_ids, xy_, tolerance=100)
+    assert drifted.coordinates['mode'] == 'full'
+
+    fresh = Members(player_ids)
+    fresh.update_coordinates(pulse)
+    assert get_stress(drifted, pulse) == pytest.approx(get_stress(fresh, pulse), rel=0.05)
+
+def test_distance_matrix_matches_pairs():
+    patternizer = make_patternizer(10, 12)
+    distances = patternizer.get_distance_matrix()
+
+    assert len(distances) == 10 * 9 + 10
+    for player_id, opponent_id, distance in distances[['player_id', 'opponent_id', 'distance']].values:
+        expected = patternizer.get_distance(player_id, opponent_id) if opponent_id is not None \
+            else patternizer.get_distance(player_id)
+
+        if expected is None:
+            assert isnan(distance)
+        else:
+            assert distance == pytest.approx(expected, rel=1e-9, abs=1e-12)
+
+def test_distance_matrix_memory_is_players_squared():
+    n_players = 200
+    patternizer = make_patternizer(n_players, 15, seed=1)
+    patternizer.get_patterns()
+    patternizer.get_counted()
+    n_songs = len(patternizer.songs.df)
+
+    tracemalloc.start()
+    patternizer.get_distance_matrix()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    # well under even one song x player x player array of floats
+    assert peak < 8 * n_songs * n_players**2 / 5
@@ -0,0 +1,366 @@
+''' Database housekeeping '''
+
+import re
+import json
+from inspect import signature
+from datetime import date
+from threading import Lock
+from time import perf_counter
+
+import pytest
+from numpy import nan, int64
+from pandas import DataFrame, Timestamp, NaT
+
+from psycopg2.extras import Json
+from sqlalchemy.exc import ProgrammingError
+
+from common.calling import Caller, Quoter
+from common.data import Database
+from display.streaming import Streamable
+
+def test_reconnect_backoff_leaves_http_retries_alone():
+    # the HTTP session Database inherits should retry like every other Caller
+    for setting in ['retries', 'backoff_base', 'backoff_cap', 'get_backoff']:
+        assert getattr(Database, setting) is getattr(Caller, setting)
+
+def test_reconnect_backoff_is_capped():
+    database = Database.__new__(Database)
+    waits = [database.get_db_backoff(attempt) for attempt in range(1, 20)]
+
+    assert all(0 <= wait <= Database.db_backoff_cap for wait in waits)
+
+def make_database():
+    ''' a database that records SQL instead of running it '''
+    database = Database.__new__(Database)
+    database.db = 'paws'
+    database.schema_loaded = True
+    database.name_index = {'results': 'view', 'results_m': 'materialized',
+                           'pulse': 'view', 'pulse_m': 'materialized', 'votes': 'table', 'players': 'table'}
+    database.names = {}
+    database.dependencies = {'results_m': {'tables': {'votes', 'songs'}, 'views': [], 'unique': True},
+                             'pulse_m': {'tables': set(), 'views': ['results_m'], 'unique': False},
+                             'durations_m': {'tables': {'tracks'}, 'views': [], 'unique': True}}
+    database.stale_views = set()
+    database.materialize_lock = Lock()
+
+    database.sql = []
+    database.execute_sql = database.sql.append
+    database.read_sql = lambda sql: database.sql.append(sql)
+
+    return database
+
+def test_reading_never_refreshes():
+    database = make_database()
+    database.get_table('pulse')
+    database.get_table('results')
+
+    assert not any('REFRESH' in sql for sql in database.sql)
+
+def test_writer_refreshes_only_stale_views_upstream_first():
+    database = make_database()
+    database.mark_written('votes')
+
+    # reads in between still don't refresh
+    database.get_table('pulse')
+    assert not any('REFRESH' in sql for sql in database.sql)
+
+    database.materialize()
+    refreshes = [sql for sql in database.sql if 'REFRESH' in sql]
+    assert refreshes == ['REFRESH MATERIALIZED VIEW CONCURRENTLY "paws".results_m;',
+                         'REFRESH MATERIALIZED VIEW "paws".pulse_m;']
+
+    # nothing left to do until the next write
+    database.materialize()
+    assert len([sql for sql in database.sql if 'REFRESH' in sql]) == 2
+
+def test_fingerprint_lives_on_the_league_row():
+    database = make_database()
+    database.quoter = Quoter()
+    database.table_index = {'leagues': {'keys': ['league_id'], 'values': ['league_name', 'fingerprint'],
+                                        'columns': ['league_id', 'league_name', 'fingerprint']}}
+
+    sheets = {'votes.csv': 'abc', 'songs.csv': 'def'}
+    database.store_fingerprint('league-1', sheets, '2022-02-01')
+    assert database.sql[-1].startswith('UPDATE "paws".leagues SET fingerprint = ')
+    assert database.sql[-1].endswith("::jsonb WHERE league_id = 'league-1';")
+
+    stored = json.dumps({'sheets': sheets, 'watermark': '2022-02-01'})
+    database.read_sql = lambda sql: DataFrame({'fingerprint': [stored]})
+    assert database.get_fingerprint('league-1') == {'sheets': sheets, 'watermark': '2022-02-01'}
+
+def test_fingerprint_needs_the_column():
+    database = make_database()
+    database.table_index = {'leagues': {'keys': ['league_id'], 'values': ['league_name'],
+                                        'columns': ['league_id', 'league_name']}}
+
+    # without it every export is stored in full, as before
+    database.store_fingerprint('league-1', {}, None)
+    assert database.get_fingerprint('league-1') is None
+    assert database.sql == []
+
+def read_copy_text(buffer):
+    ''' read rows back the way COPY's text format does '''
+    escapes = {'\\\\': '\\', '\\t': '\t', '\\n': '\n', '\\r': '\r'}
+    rows = []
+    for line in buffer.getvalue().split('\n')[:-1]:
+        row = []
+        for field in line.split('\t'):
+            if field == '\\N':
+                row.append(None)
+            else:
+                row.append(re.sub(r'\\.', lambda m: escapes[m.group(0)], field))
+        rows.append(tuple(row))
+
+    return rows
+
+def as_text(param):
+    ''' what a bound parameter looks like once stored, in text '''
+    if param is None:
+        text = None
+    elif isinstance(param, Json):
+        text = json.dumps(param.adapted)
+    else:
+        text = str(param)
+
+    return text
+
+def make_frame():
+    return DataFrame({'song_id': [1, 2, 3, 4],
+                      'comment': ['a \\N in the text', 'back\\slash and\ttab', 'two\nlines\r', None],
+                      'vote': [3.0, nan, -1.0, 2.0],
+                      'loudness': [-5.25, 0.5, nan, 1e-3],
+                      'tags': [['indie', 'rock'], {'a': '"quoted"'}, None, []],
+                      'explicit': [True, False, None, True],
+                      'count': [int64(7), int64(0), int64(-3), int64(10)],
+                      'created_date': [date(2022, 1, 1), Timestamp('2022-02-01 12:30:00'), NaT, None]})
+
+def test_copy_text_round_trips():
+    database = make_database()
+    database.quoter = Quoter()
+    df = make_frame()
+
+    rows = read_copy_text(database.to_copy_buffer(df))
+
+    # a real \N and other backslashes come back as text, only missing values come back as NULL
+    assert [row[1] for row in rows] == ['a \\N in the text', 'back\\slash and\ttab', 'two\nlines\r', None]
+    assert [row[2] for row in rows] == ['3', None, '-1', '2']
+    assert json.loads(rows[0][4]) == ['indie', 'rock']
+    assert json.loads(rows[1][4]) == {'a': '"quoted"'}
+
+def test_copy_and_params_store_the_same_values():
+    database = make_database()
+    database.quoter = Quoter()
+    df = make_frame()
+
+    copied = read_copy_text(database.to_copy_buffer(df))
+    bound = [tuple(as_text(param) for param in row) for row in database.to_params(df)]
+
+    assert copied == bound
+
+def make_upserter(engine):
+    ''' a database that records what each upsert engine would send '''
+    database = make_database()
+    database.quoter = Quoter()
+    database.connection_type = 'alchemy'
+    database.upsert_engine = engine
+    Streamable.__init__(database)
+    database.table_index = {'songs': {'keys': ['league_id', 'song_id'], 'values': ['round_id', 'submitter_id', 'comment'],
+                                      'columns': ['league_id', 'song_id', 'round_id', 'submitter_id', 'comment']}}
+
+    database.sent = []
+    def alchemy_connect(method, sql, **kwargs):
+        database.sent.append((method, sql, kwargs))
+        return [(True,)] * len(kwargs.get('rows', [])) if method == 'params' else [(True,)]
+    database.alchemy_connect = alchemy_connect
+    database.values_rows = lambda table_name, df, keys: database.sent.append(('values', table_name, df))
+
+    return database
+
+def make_songs():
+    return DataFrame({'league_id': ['league-1'] * 2, 'song_id': [1, 2], 'round_id': ['round-1'] * 2,
+                      'submitter_id': ['player-1', 'player-2'], 'comment': ['first', None]})
+
+def test_values_engine_is_the_default():
+    assert signature(Database.__init__).parameters['upsert_engine'].default == 'values'
+
+def test_params_engine_binds_rows():
+    database = make_upserter('params')
+    database.upsert_table('songs', make_songs())
+
+    method, sql, kwargs = database.sent[0]
+    assert method == 'params'
+    assert sql == ('INSERT INTO "paws".songs AS t (league_id, song_id, round_id, submitter_id, comment) VALUES %s '
+                   'ON CONFLICT (league_id, song_id) DO UPDATE SET round_id = EXCLUDED.round_id, '
+                   'submitter_id = EXCLUDED.submitter_id, comment = EXCLUDED.comment '
+                   'WHERE (t.round_id::text IS DISTINCT FROM EXCLUDED.round_id::text) '
+                   'OR (t.submitter_id::text IS DISTINCT FROM EXCLUDED.submitter_id::text) '
+                   'OR (t.comment::text IS DISTINCT FROM EXCLUDED.comment::text) '
+                   'RETURNING (xmax = 0) AS inserted;')
+    assert kwargs['rows'] == [('league-1', 1, 'round-1', 'player-1', 'first'), ('league-1', 2, 'round-1', 'player-2', None)]
+    assert kwargs['fetch']
+
+def test_copy_engine_loads_a_temp_table():
+    database = make_upserter('copy')
+    database.upsert_table('songs', make_songs())
+
+    method, (sql_before, sql_copy, sql_after), kwargs = database.sent[0]
+    assert method == 'copy'
+    assert sql_before == 'CREATE TEMP TABLE _upsert_songs (LIKE "paws".songs INCLUDING DEFAULTS) ON COMMIT DROP;'
+    assert sql_copy == 'COPY _upsert_songs (league_id, song_id, round_id, submitter_id, comment) FROM STDIN WITH (FORMAT text);'
+    assert sql_after.startswith('INSERT INTO "paws".songs AS t (league_id, song_id, round_id, submitter_id, comment) '
+                                'SELECT league_id, song_id, round_id, submitter_id, comment FROM _upsert_songs '
+                                'ON CONFLICT (league_id, song_id) DO UPDATE')
+    assert kwargs['buffer'].getvalue() == 'league-1\t1\tround-1\tplayer-1\tfirst\nleague-1\t2\tround-1\tplayer-2\t\\N\n'
+
+@pytest.mark.parametrize('engine', ['params', 'copy'])
+def test_partial_writes_update_in_place(engine):
+    database = make_upserter(engine)
+
+    # only some columns, as when comments are filled in later
+    database.upsert_table('songs', make_songs()[['league_id', 'song_id', 'comment']])
+    assert [sent[0] for sent in database.sent] == ['values']
+
+    # a value column that is empty everywhere isn't written either
+    database.upsert_table('songs', make_songs().assign(comment=None))
+    assert [sent[0] for sent in database.sent] == ['values', 'values']
+
+def test_changed_rows_are_guarded():
+    database = make_upserter('params')
+
+    assert database.is_distinct(['title', 'tags'], 't', 'EXCLUDED') == \
+        '(t.title::text IS DISTINCT FROM EXCLUDED.title::text) OR (t.tags::text IS DISTINCT FROM EXCLUDED.tags::text)'
+
+    # tables that are all keys have nothing to update
+    assert database.on_conflict(['league_id', 'song_id'], ['league_id', 'song_id']) == \
+        'ON CONFLICT (league_id, song_id) DO NOTHING RETURNING (xmax = 0) AS inserted'
+
+    # and the literal UPDATE skips unchanged rows the same way
+    sql = database.update_rows('songs', make_songs().iloc[:1], ['league_id', 'song_id'])
+    assert sql.endswith('WHERE (c.league_id = t.league_id) AND (c.song_id = t.song_id) AND '
+                        '((t.round_id::text IS DISTINCT FROM c.round_id::text) '
+                        'OR (t.submitter_id::text IS DISTINCT FROM c.submitter_id::text) '
+                        'OR (t.comment::text IS DISTINCT FROM c.comment::text));')
+
+def test_write_counts_split_returned_rows(capsys):
+    database = make_upserter('params')
+
+    # only written rows come back, flagged True when they are new
+    counts = database.count_writes('songs', [(True,), (False,), (True,)], 5)
+    assert counts == {'inserted': 2, 'updated': 1, 'unchanged': 2}
+    assert '...songs: 2 inserted, 1 updated, 2 unchanged' in capsys.readouterr().out
+
+@pytest.mark.parametrize('returned, stale', [([], False), ([(False,)], True), ([(True,)], True)])
+def test_only_writes_make_views_stale(returned, stale):
+    database = make_upserter('params')
+    database.dependencies['songs_m'] = {'tables': {'songs'}, 'views': [], 'unique': True}
+    database.alchemy_connect = lambda method, sql, **kwargs: returned
+
+    database.upsert_table('songs', make_songs())
+    assert ('songs_m' in database.stale_views) == stale
+
+@pytest.mark.parametrize('failure', [ProgrammingError('SELECT', {}, Exception('permission denied for pg_depend')), None])
+def test_writes_survive_without_the_catalog(failure):
+    database = make_database()
+    Streamable.__init__(database)
+    database.dependencies = None
+    database.name_index.update({'durations_m': 'materialized', 'durations': 'view'})
+
+    def read_sql(sql):
+        if failure:
+            raise failure
+    database.read_sql = read_sql
+
+    # the write already happened, so every materialized view is stale rather than the error coming out
+    database.mark_written('votes')
+    assert database.stale_views == {'results_m', 'pulse_m', 'durations_m'}
+
+def make_schema(n_tables=40, n_columns=12):
+    ''' schema tables shaped like _schema_tables and _schema_names, keys listed again as foreign keys '''
+    rows = []
+    names = []
+    for t in range(n_tables):
+        table_name = f'table_{t}'
+        for c in range(n_columns):
+            column_name = f'column_{c}'
+            if c < 2:
+                rows.append((table_name, column_name, 'PRIMARY KEY'))
+            if c % 3 == 1:
+                rows.append((table_name, column_name, 'FOREIGN KEY'))
+            if c >= 2:
+                rows.append((table_name, column_name, None if c % 2 else 'UNIQUE'))
+        names += [(table_name, 'table'), (f'view_{t}', 'VIEW')]
+        if t % 2:
+            names.append((f'view_{t}_m', 'materialized'))
+
+    return DataFrame(rows, columns=['table_name', 'column_name', 'column_type']), \
+        DataFrame(names, columns=['table_name', 'relationship'])
+
+def make_schema_database():
+    database = make_database()
+    database.table_schema, database.name_schema = make_schema()
+    database.index_schema()
+
+    return database
+
+def query_table_name(database, table_name):
+    ''' how table names were found before the schema was indexed '''
+    relationship = database.name_schema.query('table_name.str.lower() == @table_name.lower()')['relationship'].iloc[0].lower()
+    if relationship == 'view' and len(database.name_schema.query('table_name.str.lower() == @table_name.lower() + "_m"')['relationship']):
+        name = table_name + '_m'
+    else:
+        name = table_name
+
+    return f'"{database.db}".{name.lower()}'
+
+def query_columns(database, table_name, match_cols=[]):
+    ''' how keys, values and columns were found before the schema was indexed '''
+    schema = database.table_schema
+    keys = schema.query('(column_type == "PRIMARY KEY") & (table_name == @table_name.lower())')['column_name'].to_list()
+
+    q = '(column_type != "PRIMARY KEY") & (table_name == @table_name.lower())'
+    if len(match_cols):
+        q += ' & (column_name in @match_cols)'
+    values = schema.drop_duplicates(['table_name', 'column_name']).query(q)['column_name'].to_list()
+
+    columns = schema.drop_duplicates(['table_name', 'column_name'])\
+        .query('table_name == @table_name.lower()')['column_name'].to_list()
+
+    return keys, values, columns
+
+def test_schema_index_matches_schema_queries():
+    database = make_schema_database()
+
+    for table_name in database.name_schema['table_name']:
+        for name in [table_name, table_name.upper()]:
+            assert database.table_name(name) == query_table_name(database, name)
+
+    match_cols = ['column_1', 'column_4', 'column_7', 'missing']
+    for table_name in database.table_schema['table_name'].unique().tolist() + ['missing']:
+        for name in [table_name, table_name.upper()]:
+            for cols in [[], match_cols]:
+                keys, values, columns = query_columns(database, name, cols)
+                assert database.get_keys(name) == keys
+                assert database.get_values(name, match_cols=cols) == values
+                assert database.get_columns(name) == columns
+
+def test_schema_index_is_faster_than_queries():
+    # measured 480ms for the queries vs 0.3ms for the index across 40 tables, plus 5ms to build it
+    database = make_schema_database()
+    table_names = [f'table_{t}' for t in range(40)]
+    match_cols = ['column_1', 'column_4']
+
+    start = perf_counter()
+    for table_name in table_names:
+        query_table_name(database, table_name)
+        query_columns(database, table_name, match_cols)
+    queried = perf_counter() - start
+
+    start = perf_counter()
+    for table_name in table_names:
+        database.table_name(table_name)
+        database.get_keys(table_name)
+        database.get_values(table_name, match_cols=match_cols)
+        database.get_columns(table_name)
+    indexed = perf_counter() - start
+
+    assert indexed * 10 < queried
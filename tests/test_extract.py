@@ -0,0 +1,250 @@
+''' Reading league exports '''
+
+import tracemalloc
+from time import perf_counter
+from io import BytesIO
+from zipfile import ZipFile, ZIP_DEFLATED
+
+import pytest
+from dateutil.parser import parse, ParserError
+from pandas import DataFrame, Series, concat
+
+from preparing.audio import FMer
+from preparing.extract import Scraper, Stripper
+
+PLAYERS = 40
+ROUNDS = 25
+VOTES_PER_SONG = 150
+CHUNKSIZE = 10000
+
+def make_export():
+    ''' zip of CSVs shaped like a MusicLeague export, with many more votes than a real league '''
+    players = [f'player-{p}' for p in range(PLAYERS)]
+    rounds = [f'round-{r}' for r in range(ROUNDS)]
+
+    competitors = DataFrame({'ID': players, 'Name': [f'Player {p}' for p in range(PLAYERS)]})
+    rounds_df = DataFrame({'ID': rounds, 'Created': '2022-01-01T00:00:00Z', 'Name': rounds,
+                           'Description': '', 'Playlist URL': ''})
+    submissions = DataFrame([{'Spotify URI': f'spotify:track:{r}-{p}', 'Title': '', 'Album': '', 'Artist(s)': '',
+                              'Submitter ID': players[p], 'Created': f'2022-01-{1 + r % 28:02d}T12:00:00Z',
+                              'Comment': '', 'Round ID': rounds[r]} \
+                             for r in range(ROUNDS) for p in range(PLAYERS)])
+    votes = DataFrame([{'Spotify URI': f'spotify:track:{r}-{p}', 'Voter ID': players[(p + v) % PLAYERS],
+                        'Created': f'2022-02-{1 + r % 28:02d}T12:00:00Z', 'Points Assigned': v % 3,
+                        'Comment': 'a comment long enough to make the sheet worth streaming', 'Round ID': rounds[r]} \
+                       for r in range(ROUNDS) for p in range(PLAYERS) for v in range(VOTES_PER_SONG)])
+
+    content = BytesIO()
+    with ZipFile(content, 'w', compression=ZIP_DEFLATED) as z:
+        for sheet, df in zip(Stripper.sheets, [competitors, rounds_df, submissions, votes]):
+            z.writestr(f'{sheet}.csv', df.to_csv(index=False))
+
+    return content.getvalue()
+
+@pytest.fixture(scope='module')
+def export():
+    return make_export()
+
+@pytest.fixture
+def scraper(stub_server, export):
+    stub_server.routes['/data'] = lambda handler, body: (200, {'Content-Type': 'application/zip'}, export)
+
+    scraper = Scraper()
+    scraper.get_url = lambda **kwargs: f'{stub_server.url}/{kwargs["end"]}'
+
+    return scraper
+
+def test_stream_download_is_seekable_file(scraper):
+    data_zip = scraper.get_data_zip('league', stream=True)
+
+    # ZipFile members can only be opened over files that say they are seekable
+    assert data_zip.fp.seekable()
+    assert set(Stripper.sheets) == {n[:-len('.csv')] for n in data_zip.namelist()}
+
+    Stripper().close_zip(data_zip)
+
+def test_stream_matches_full_read(scraper, export):
+    stripper = Stripper()
+
+    players, rounds, songs, votes, tracks = stripper.unzip_results(ZipFile(BytesIO(export)))
+
+    data_zip = scraper.get_data_zip('league', stream=True)
+    r_file = data_zip.fp
+    s_players, s_rounds, s_songs, s_votes, s_tracks = stripper.stream_results(data_zip, chunksize=CHUNKSIZE)
+
+    batches = list(s_votes)
+    assert all(len(batch) <= CHUNKSIZE for batch in batches)
+    assert len(batches) == -(-PLAYERS * ROUNDS * VOTES_PER_SONG // CHUNKSIZE)
+
+    # reading every batch closes the export and the file under it
+    assert r_file.closed
+
+    for full, streamed in [(players, s_players), (rounds, s_rounds), (songs, s_songs), (tracks, s_tracks)]:
+        assert full.reset_index(drop=True).equals(streamed.reset_index(drop=True))
+
+    assert votes.reset_index(drop=True).equals(concat(batches, ignore_index=True))
+
+def test_stream_memory_is_bounded(scraper, export):
+    stripper = Stripper()
+
+    def peak_memory(read):
+        tracemalloc.start()
+        read()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        return peak
+
+    def read_stream():
+        data_zip = scraper.get_data_zip('league', stream=True)
+        _, _, _, votes, _ = stripper.stream_results(data_zip, chunksize=CHUNKSIZE)
+        for _ in votes:
+            pass
+
+    def read_full():
+        stripper.unzip_results(ZipFile(BytesIO(export)))
+
+    # only a chunk of votes is held at a time
+    assert peak_memory(read_stream) < peak_memory(read_full) / 3
+
+def test_abandoned_stream_is_closed(scraper):
+    stripper = Stripper()
+
+    data_zip = scraper.get_data_zip('league', stream=True)
+    r_file = data_zip.fp
+    _, _, _, votes, _ = stripper.stream_results(data_zip, chunksize=CHUNKSIZE)
+    next(votes)
+
+    # storing can fail partway through the votes
+    stripper.close_zip(data_zip)
+    assert r_file.closed
+
+    votes.close()
+
+# titles as Spotify has them, with what the per-title cleaner made of them
+TITLES = [
+    ('Bohemian Rhapsody - Remastered 2011', 'Bohemian Rhapsody', None),
+    ('Blinding Lights', 'Blinding Lights', None),
+    ('Levitating (feat. DaBaby)', 'Levitating', None),
+    ('Wake Me Up - Avicii Remix', 'Wake Me Up', 'Avicii'),
+    ('Heads Will Roll - A-Trak Remix', 'Heads Will Roll', 'A-Trak'),
+    ('Midnight City (Eric Prydz Remix)', 'Midnight City', 'Eric Prydz'),
+    ('Lose Yourself - From "8 Mile" Soundtrack', 'Lose Yourself', None),
+    ('Old Town Road (feat. Billy Ray Cyrus) - Remix', 'Old Town Road', '< remix >'),
+    ('Hey Ya! - Radio Mix / Club Mix', 'Hey Ya!', 'Radio Mix / Club'),
+    ('Dancing On My Own - Radio Edit', 'Dancing On My Own', None),
+    ('Creep - Live', 'Creep', '< live >'),
+    ('Jolene - Live at the Grand Ole Opry', 'Jolene', '< live >'),
+    ('Hallelujah (Live)', 'Hallelujah', '< live >'),
+    ('Under Pressure - Live at Wembley Stadium; 1986 Remaster', 'Under Pressure', '< live >'),
+    ('Sunflower - Spider-Man: Into the Spider-Verse (with Swae Lee)', 'Sunflower', None),
+    ('Señorita', 'Señorita', None),
+    ("Don't Start Now (Purple Disco Machine Remix)", "Don't Start Now", 'Purple Disco Machine'),
+    ('Islands in the Stream (Duet with Dolly Parton)', 'Islands in the Stream', None),
+    ('Mr. Brightside', 'Mr. Brightside', None),
+    ('Rather Be (feat. Jess Glynne)', 'Rather Be', None),
+    ('Get Lucky (Radio Edit) [feat. Pharrell Williams & Nile Rodgers]', 'Get Lucky (Radio Edit)', None),
+    ('One More Time - Short Radio Edit', 'One More Time', None),
+    ('Tití Me Preguntó', 'Tití Me Preguntó', None),
+    ('Doses & Mimosas', 'Doses & Mimosas', None),
+    ('Gimme! Gimme! Gimme! (A Man After Midnight)', 'Gimme! Gimme! Gimme! (A Man After Midnight)', None),
+    ('Somebody That I Used To Know - Tiësto Remix', 'Somebody That I Used To Know', 'Tiësto'),
+    ('Stay (with Justin Bieber)', 'Stay', None),
+    ("Can't Hold Us (feat. Ray Dalton)", "Can't Hold Us", None),
+    ('Hotline Bling', 'Hotline Bling', None),
+    ('Losing My Religion - Remastered', 'Losing My Religion', None),
+    ('Atlantic City - Live in Barcelona with the E Street Band', 'Atlantic City', '< live >'),
+    ('Latch (Acoustic)', 'Latch (Acoustic)', None),
+    ('Praise You (Fatboy Slim Mix)', 'Praise You', 'Fatboy Slim'),
+    ('Mix Tape', 'Mix Tape', None),
+    ('Remixes of You', 'Remixes of You', None),
+    ('Gold Dust - DJ Fresh VIP Mix', 'Gold Dust', 'DJ Fresh VIP'),
+    ('Strobe - Radio Edit', 'Strobe', None),
+    ('Where Is My Mind? - Remastered', 'Where Is My Mind?', None),
+    ('A Sky Full of Stars - Hardwell Remix', 'A Sky Full of Stars', 'Hardwell'),
+    ('Live Forever', 'Live Forever', None),
+]
+
+def test_titles_clean_the_same_as_a_column_or_one_at_a_time():
+    stripper = Stripper()
+    titles = Series([title for title, _, _ in TITLES] * 2)
+
+    expected = [(cleaned, mix) for _, cleaned, mix in TITLES] * 2
+    assert list(stripper.clean_titles(titles).itertuples(index=False, name=None)) == expected
+    assert [stripper.clean_title(title) for title in titles] == expected
+
+def test_lastfm_titles_clean_like_tracks():
+    fmer = FMer()
+    titles = Series([title for title, _, _ in TITLES])
+
+    assert list(fmer.clean_titles(titles).itertuples(index=False, name=None)) == \
+        [fmer.clean_title(title) for title in titles] == [(cleaned, mix) for _, cleaned, mix in TITLES]
+
+def make_titles(n_titles, n_distinct):
+    ''' titles shaped like TITLES, numbered so only some repeat '''
+    return [TITLES[i % len(TITLES)][0].replace(' ', f'{(i * 7919) % n_distinct // len(TITLES)} ', 1) for i in range(n_titles)]
+
+def test_missing_titles_clean_to_nothing():
+    titles = Series([TITLES[0][0], None, TITLES[0][0]], index=[3, 5, 7], dtype=object)
+    titles_df = Stripper().clean_titles(titles)
+
+    assert titles_df.index.tolist() == [3, 5, 7]
+    assert list(titles_df.itertuples(index=False, name=None)) == [TITLES[0][1:], (None, None), TITLES[0][1:]]
+
+def test_titles_clean_faster_as_a_column():
+    # measured 1.6s for clean_tracks on 100k titles (49k distinct), where the per-title apply took 26.9s
+    stripper = Stripper()
+    titles = make_titles(100000, 50000)
+
+    start = perf_counter()
+    titles_df = stripper.clean_titles(Series(titles))
+    column = perf_counter() - start
+
+    start = perf_counter()
+    one_at_a_time = [stripper.clean_title(title) for title in titles]
+    single = perf_counter() - start
+
+    assert list(titles_df.itertuples(index=False, name=None)) == one_at_a_time
+    assert column < single
+
+DATES = [
+    '2022-01-01T23:30:00Z',
+    '2022-01-01T23:30:00.123Z',
+    '2022-01-01T23:30:00-05:00',
+    '2022-01-01T00:30:00+09:30',
+    '2022-01-01T12:00:00 PST',
+    '2022-01-01 12:00:00',
+    '2022-01-01',
+    '20220105',
+    '2022-1-5T10:00:00Z',
+    'Jan 5 2022',
+]
+
+MALFORMED = ['2022-01-01Tgarbage', '2022-01-01T25:00:00Z', '2022-13-01', '2022-02-30T00:00:00Z', 'not a date']
+
+def test_dates_parse_the_same_as_one_at_a_time():
+    # dates are taken as written, so a time zone never moves the day
+    created = Series(DATES * 2)
+    assert Stripper().parse_dates(created).tolist() == [parse(c).date() for c in created]
+
+@pytest.mark.parametrize('malformed', MALFORMED)
+def test_malformed_dates_fail_like_before(malformed):
+    with pytest.raises(ParserError):
+        parse(malformed)
+    with pytest.raises(ParserError):
+        Stripper().parse_dates(Series(DATES + [malformed]))
+
+def test_dates_parse_faster_than_one_at_a_time():
+    # measured 1.9s vs 0.02s for 10k timestamps and 15.8s vs 0.06s for 100k
+    created = Series([f'2022-{1 + i % 12:02d}-{1 + i % 28:02d}T{i % 24:02d}:{i % 60:02d}:00Z' for i in range(10000)])
+
+    start = perf_counter()
+    one_at_a_time = created.apply(lambda x: parse(x).date())
+    slow = perf_counter() - start
+
+    start = perf_counter()
+    dates = Stripper().parse_dates(created)
+    fast = perf_counter() - start
+
+    assert dates.tolist() == one_at_a_time.tolist()
+    assert fast * 10 < slow
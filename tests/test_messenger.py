@@ -0,0 +1,139 @@
+''' Reading round notifications from Gmail '''
+
+import json
+import re
+from email import message_from_bytes
+from urllib.parse import urlparse, parse_qs
+
+import httplib2
+import pytest
+from googleapiclient.discovery import build_from_document
+from pandas import DataFrame
+
+import preparing.messenger
+from common.words import Texter
+from preparing.messenger import GMailer
+
+LEAGUES = {'league-1': 'Brunch Bangers', 'league-2': 'Songs About Weather'}
+
+def make_discovery(root_url):
+    ''' the parts of the Gmail discovery document that checking mail uses '''
+    user_id = {'type': 'string', 'location': 'path', 'required': True}
+    return {'kind': 'discovery#restDescription', 'name': 'gmail', 'version': 'v1',
+            'rootUrl': f'{root_url}/', 'servicePath': '', 'batchPath': 'batch/gmail/v1',
+            'parameters': {'fields': {'type': 'string', 'location': 'query'}},
+            'schemas': {'ListMessagesResponse': {'id': 'ListMessagesResponse', 'type': 'object'},
+                        'Message': {'id': 'Message', 'type': 'object'}},
+            'resources': {'users': {'resources': {'messages': {'methods': {
+                'list': {'id': 'gmail.users.messages.list', 'path': 'gmail/v1/users/{userId}/messages',
+                         'httpMethod': 'GET', 'parameterOrder': ['userId'],
+                         'response': {'$ref': 'ListMessagesResponse'},
+                         'parameters': {'userId': user_id, 'q': {'type': 'string', 'location': 'query'}}},
+                'get': {'id': 'gmail.users.messages.get', 'path': 'gmail/v1/users/{userId}/messages/{id}',
+                        'httpMethod': 'GET', 'parameterOrder': ['userId', 'id'],
+                        'response': {'$ref': 'Message'},
+                        'parameters': {'userId': user_id, 'id': {'type': 'string', 'location': 'path', 'required': True},
+                                       'format': {'type': 'string', 'location': 'query'}}},
+                }}}}}}
+
+def make_snippet(message_id):
+    n = int(message_id.split('-')[-1])
+    league_name = list(LEAGUES.values())[n % 2]
+
+    return f'The votes are in for the latest round of the {league_name} league. See who won!'
+
+def reply_to_batch(handler, body):
+    ''' answer each part of a multipart batch, with a 404 for messages that are gone '''
+    boundary = 'batch_stub'
+    message = message_from_bytes(b'Content-Type: ' + handler.headers['Content-Type'].encode() + b'\r\n\r\n' + body)
+
+    parts = []
+    for part in message.get_payload():
+        request_line = part.get_payload().splitlines()[0]
+        message_id = urlparse(request_line.split()[1]).path.split('/')[-1]
+        assert parse_qs(urlparse(request_line.split()[1]).query)['fields'] == ['snippet']
+
+        if message_id.startswith('gone'):
+            status, content = '404 Not Found', {'error': {'code': 404, 'message': 'Not Found'}}
+        else:
+            status, content = '200 OK', {'snippet': make_snippet(message_id)}
+
+        parts.append(f'--{boundary}\r\nContent-Type: application/http\r\n'
+                     f'Content-ID: <response-{part["Content-ID"][1:-1]}>\r\n\r\n'
+                     f'HTTP/1.1 {status}\r\nContent-Type: application/json\r\n\r\n{json.dumps(content)}\r\n')
+
+    content = (''.join(parts) + f'--{boundary}--\r\n').encode()
+
+    return 200, {'Content-Type': f'multipart/mixed; boundary={boundary}'}, content
+
+class StubDatabase:
+    def get_leagues(self):
+        return DataFrame({'league_id': list(LEAGUES.keys()), 'league_name': list(LEAGUES.values())})
+
+class StubRecorder:
+    def __init__(self):
+        self.times = {}
+
+    def get_time(self, item):
+        return self.times.get(item)
+
+    def set_time(self, item):
+        self.times[item] = True
+
+@pytest.fixture
+def gmailer():
+    # skip the token refresh, which needs real credentials
+    gmailer = GMailer.__new__(GMailer)
+    gmailer.user_id = 'me'
+    gmailer.credentials = None
+    gmailer.database = StubDatabase()
+    gmailer.texter = Texter()
+    gmailer.recorder = StubRecorder()
+
+    return gmailer
+
+@pytest.fixture
+def service(stub_server):
+    stub_server.routes['/batch/gmail/v1'] = reply_to_batch
+
+    return build_from_document(make_discovery(stub_server.url), http=httplib2.Http())
+
+def get_batches(stub_server):
+    ''' how many messages went out in each batch '''
+    return [len(re.findall(rb'^GET ', body, flags=re.MULTILINE)) \
+            for command, path, _, body in stub_server.calls if path == '/batch/gmail/v1']
+
+def test_snippets_come_in_batches(stub_server, service, gmailer):
+    message_ids = [f'message-{m}' for m in range(118)] + ['gone-0', 'gone-1']
+    snippets = gmailer.get_snippets(service, message_ids)
+
+    assert get_batches(stub_server) == [50, 50, 20]
+
+    # messages that fail are skipped and the rest still come through
+    assert sorted(snippets) == sorted(make_snippet(m) for m in message_ids[:118])
+
+def test_check_mail_finds_leagues(stub_server, service, gmailer, monkeypatch):
+    messages = {'messages': [{'id': f'message-{m}'} for m in range(3)], 'resultSizeEstimate': 3}
+    stub_server.routes['/gmail/v1/users/me/messages'] = \
+        lambda handler, body: (200, {'Content-Type': 'application/json'}, json.dumps(messages).encode())
+
+    class Service:
+        ''' build() hands back the stubbed service for the with block '''
+        def __enter__(self):
+            return service
+
+        def __exit__(self, *args):
+            pass
+
+    monkeypatch.setattr(preparing.messenger, 'build', lambda *args, **kwargs: Service())
+
+    league_ids = gmailer.check_mail()
+
+    assert sorted(league_ids) == sorted(LEAGUES.keys())
+    assert get_batches(stub_server) == [3]
+    assert 'check_mail' not in gmailer.recorder.times
+
+def test_extract_leagues_skips_other_mail(gmailer):
+    snippets = [make_snippet('message-0'), 'Your weekly digest is here', make_snippet('message-1')]
+
+    assert gmailer.extract_leagues(snippets) == [LEAGUES['league-1'], LEAGUES['league-2']]
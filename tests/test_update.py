@@ -0,0 +1,117 @@
+''' Storing league exports '''
+
+from threading import Lock
+
+import pytest
+from pandas import DataFrame
+
+from preparing.update import Updater
+
+SHEETS = {'votes': 'abc'}
+
+class StubParts:
+    ''' stands in for the scraper, stripper, cloud storage, recorder and database an Updater uses '''
+    def __init__(self, fail=None):
+        self.fail = fail
+        self.steps = []
+        self.fingerprints = {}
+
+    # scraper
+    def get_my_leagues(self):
+        return None
+
+    def get_data_zip(self, league_id, stream=False):
+        return f'{league_id}.zip'
+
+    # stripper
+    def extract_my_leagues(self, page):
+        return DataFrame()
+
+    def fingerprint_zip(self, data_zip):
+        return SHEETS
+
+    def unzip_results(self, data_zip):
+        return 'results'
+
+    def close_zip(self, data_zip):
+        pass
+
+    # cloud storage
+    def clear_items(self, league_id):
+        self.step('clear', league_id)
+
+    # recorder
+    def get_fingerprint(self, league_id):
+        return self.fingerprints.get(league_id)
+
+    def set_fingerprint(self, league_id, sheets, watermark):
+        self.step('fingerprint', league_id)
+        self.fingerprints[league_id] = {'sheets': sheets, 'watermark': watermark}
+
+    # database
+    def store_leagues(self, df):
+        pass
+
+    def get_league_name(self, league_id):
+        return league_id.title()
+
+    def step(self, name, league_id):
+        if self.fail == name:
+            raise ConnectionError(f'{name} went wrong')
+        self.steps.append((name, league_id))
+
+def make_updater(parts):
+    updater = Updater.__new__(Updater)
+    updater.database = parts
+    updater.scraper = parts
+    updater.stripper = parts
+    updater.gclouder = parts
+    updater.recorder = parts
+    updater.stages = {}
+    updater.stages_lock = Lock()
+
+    updater.store_league = lambda league_id, results, watermark=None: parts.step('store', league_id) or '2022-02-01'
+    updater.update_creators = lambda league_id: parts.step('creators', league_id)
+    updater.update_competitions = lambda: None
+
+    return updater
+
+@pytest.mark.parametrize('workers', [1, 2])
+def test_fingerprint_is_saved_last(workers):
+    parts = StubParts()
+    make_updater(parts).update_musicleague(league_ids=['league-a'], workers=workers)
+
+    assert parts.steps == [('store', 'league-a'), ('creators', 'league-a'), ('clear', 'league-a'), ('fingerprint', 'league-a')]
+    assert parts.fingerprints['league-a'] == {'sheets': SHEETS, 'watermark': '2022-02-01'}
+
+    # an unchanged export is skipped next time
+    make_updater(parts).update_musicleague(league_ids=['league-a'], workers=workers)
+    assert len(parts.steps) == 4
+
+@pytest.mark.parametrize('workers', [1, 2])
+def test_creator_failures_are_retried(workers):
+    parts = StubParts(fail='creators')
+    with pytest.raises(ConnectionError):
+        make_updater(parts).update_musicleague(league_ids=['league-a'], workers=workers)
+
+    assert parts.fingerprints == {}
+
+@pytest.mark.parametrize('workers', [1, 2])
+def test_clearing_failures_are_retried(workers):
+    parts = StubParts(fail='clear')
+    updater = make_updater(parts)
+
+    if workers == 1:
+        with pytest.raises(ConnectionError):
+            updater.update_musicleague(league_ids=['league-a'], workers=workers)
+    else:
+        # clearing runs in the background, so the other leagues carry on
+        updater.update_musicleague(league_ids=['league-a'], workers=workers)
+
+    assert parts.fingerprints == {}
+
+    # the next run stores the league again
+    parts.fail = None
+    make_updater(parts).update_musicleague(league_ids=['league-a'], workers=workers)
+    assert 'league-a' in parts.fingerprints
+    assert [step for step in parts.steps if step[0] == 'store'] == [('store', 'league-a')] * 2
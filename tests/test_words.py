@@ -0,0 +1,76 @@
+''' Matching names '''
+
+import random
+
+import pytest
+
+from common.words import Texter, NameMatcher
+
+FIRST = ['James', 'Mary', 'Robert', 'Patricia', 'John', 'Jennifer', 'Michael', 'Linda', 'David', 'Susan',
+         'Sarah', 'Chris', 'Dan', 'Matt', 'Lisa', 'Tony', 'Mark', 'Sandra', 'Zoë', 'José', 'Al', 'Bo']
+LAST = ['Smith', 'Johnson', 'Williams', 'Brown', 'Garcia', 'Miller', 'Rodriguez', 'Gonzalez', 'Anderson',
+        'Taylor', 'Martin', 'Lee', 'Ng', "O'Brien", 'Van der Berg']
+NICKNAMES = ['the DJ', 'my friend', 'Anon', 'Greg', 'Liz', 'Bob', 'Mike', 'Kat']
+QUERIES = 150
+
+def make_names(rng):
+    ''' league members, with a few that aren't first and last names '''
+    names = list(dict.fromkeys(f'{rng.choice(FIRST)} {rng.choice(LAST)}' for _ in range(60)))[:45]
+    return names + ['DJ Khaled Fan', 'xXgamerXx', 'mk', 'the Rock']
+
+def make_query(rng, name):
+    ''' how someone might write a member's name in a comment or export '''
+    words = name.split()
+    pick = rng.randrange(9)
+    if pick == 0:
+        query = words[0]
+    elif pick == 1:
+        query = name.lower()
+    elif pick == 2:
+        i = rng.randrange(len(name))
+        query = name[:i] + rng.choice('abcdefghijklmnopqrstuvwxyz') + name[i+1:]
+    elif pick == 3:
+        query = ''.join(w[0] for w in words)
+    elif pick == 4:
+        query = words[-1]
+    elif pick == 5:
+        query = name.replace(' ', '')
+    elif pick == 6:
+        query = rng.choice(NICKNAMES)
+    elif pick == 7:
+        query = name[:max(2, len(name) // 2)]
+    else:
+        query = name
+
+    return query
+
+@pytest.mark.parametrize('seed', [0, 1])
+def test_matches_the_same_names_as_before(seed):
+    rng = random.Random(seed)
+    names = make_names(rng)
+    queries = [make_query(rng, rng.choice(names)) for _ in range(QUERIES)]
+
+    texter = Texter()
+    matcher = NameMatcher(names)
+    for query in queries:
+        # the old matcher lowercased the names it returned
+        before = texter.find_closest_match(query, names)
+        after = matcher.find_closest_match(query)
+        assert (after or '').lower() == (before or '').lower(), query
+
+def test_short_text_is_scored_against_every_name():
+    # 'Mike' shares no piece with 'mk' but scores higher than any Michael
+    names = ['Michael Martin', 'Michael Lee', 'mk']
+    assert NameMatcher(names).find_closest_match('Mike') == Texter().find_closest_match('Mike', names) == 'mk'
+
+def test_unclear_initials_stand_in_like_before():
+    names = ["Tony O'Brien", "Michael O'Brien", 'Susan Ng', 'Bo Ng']
+    for query in ['my friend', 'Bd Ng']:
+        assert NameMatcher(names).find_closest_match(query).lower() == \
+            Texter().find_closest_match(query, names).lower()
+
+def test_exact_and_missing_text():
+    matcher = NameMatcher(['Mary Smith', 'John Lee'])
+    assert matcher.find_closest_match('Mary Smith') == 'Mary Smith'
+    assert matcher.find_closest_match(None) is None
+    assert matcher.find_closest_match('') == ''